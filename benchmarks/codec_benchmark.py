@@ -0,0 +1,89 @@
+'''
+     Decode throughput of the StorageServer value codecs against the old
+     repr()/eval() path, on a listing shaped like a typical plugin cache
+     entry, after checking that values every codec handles differently
+     come back as they went in.
+
+     Usage: python benchmarks/codec_benchmark.py [items] [rounds]
+'''
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lib"))
+
+import storageservercodec  # noqa: E402
+
+
+def listing(items):
+    return {"plugin.video.example|0123456789abcdef|": {
+        "timestamp": time.time(),
+        "timeout": 86400.0,
+        "res": [{"title": u"Episode {0}".format(i),
+                 "url": u"https://example.com/video/{0}?format=hls".format(i),
+                 "thumb": u"https://example.com/art/{0}.jpg".format(i),
+                 "plot": u"Lorem ipsum dolor sit amet " * 8,
+                 "duration": 1800 + i,
+                 "rating": 7.5,
+                 "is_folder": False,
+                 "genres": [u"Drama", u"Comedy"]}
+                for i in range(items)]}}
+
+
+ROUND_TRIP = [
+    [(1, 3), {1: u"one"}],
+    {(1, 2): [u"pair"], 2.5: None, u"text": (u"tuple",)},
+    {u"nested": [{3: [(4, 5)]}]},
+    {u"bytes": b"\x00\xff", u"list": [1, 2]},
+]
+
+
+def check():
+    for tag in sorted(storageservercodec.CODECS):
+        codec = storageservercodec.CODECS[tag]
+        for value in ROUND_TRIP:
+            data = storageservercodec.encode(value, codec)
+            if storageservercodec.decode(data) != value:
+                raise AssertionError(u"{0} changed {1!r}".format(
+                    type(codec).__name__, value))
+
+
+def measure(label, decode, data, rounds):
+    decode(data)
+    start = time.time()
+    for _ in range(rounds):
+        decode(data)
+    elapsed = time.time() - start
+    sys.stdout.write(u"{0:<24} {1:>8.2f} ms/decode {2:>8.1f} MB/s\n".format(
+        label, elapsed * 1000 / rounds,
+        len(data) * rounds / elapsed / 1024 / 1024))
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    value = listing(items)
+    check()
+
+    legacy = repr(value)
+    sys.stdout.write(u"{0} items, {1} bytes as repr\n".format(
+        items, len(legacy)))
+    measure(u"eval (old)", eval, legacy, rounds)
+    measure(u"ast.literal_eval", ast.literal_eval, legacy, rounds)
+
+    for tag in sorted(storageservercodec.CODECS):
+        codec = storageservercodec.CODECS[tag]
+        data = storageservercodec.encode(value, codec)
+        measure(type(codec).__name__, storageservercodec.decode, data, rounds)
+
+    for method in sorted(storageservercodec.COMPRESSORS):
+        data = storageservercodec.compress(value, method)
+        sys.stdout.write(u"{0}: {1} bytes\n".format(method, len(data)))
+        measure(u"{0} + decode".format(method),
+                storageservercodec.decompress, data, rounds)
+
+
+if __name__ == "__main__":
+    main()
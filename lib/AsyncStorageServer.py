@@ -0,0 +1,394 @@
+'''
+     asyncio client of the StorageServer (Python 3 only).
+
+     AsyncStorageServer offers the StorageServer client calls as
+     coroutines. It speaks the same protocol 2 frames to the same server,
+     over a small pool of its own connections, so many lookups can be in
+     flight on one event loop without a thread each:
+
+         storage = AsyncStorageServer("plugin_video_example", 24)
+         menu = await storage.cacheFunction(fetch_menu, url)
+
+     Settings, keys, compression and the in-memory cache are shared with
+     the blocking StorageServer it wraps. An instance belongs to the event
+     loop it is first used on.
+'''
+import asyncio
+import copy
+import functools
+import inspect
+
+from builtins import str as text
+
+try:
+    from . import StorageServer as _storage
+    from . import storageservercodec
+except (ImportError, ValueError):  # imported from the module path
+    import StorageServer as _storage
+    import storageservercodec
+
+
+class AsyncStorageServer(object):
+    # Connections kept open to the server, and requests sent at once.
+    connections = 8
+    # Stale cacheFunction results refreshed at the same time.
+    refresh_workers = 2
+
+    def __init__(self, table=None, timeout=24):
+        self.storage = _storage.StorageServer(table, timeout)
+        self.table = self.storage.table
+        self.idle = []
+        self.slots = None
+        self.refreshing = set()
+        self.refreshes = None
+
+    def _log(self, description, level=0):
+        self.storage._log(description, level)
+
+    async def _connect(self):
+        storage = self.storage
+        storage._sock_init()
+        try:
+            if storage._usePosixSockets():
+                connection = asyncio.open_unix_connection(storage.socket)
+            else:
+                connection = asyncio.open_connection(*storage.socket)
+            return await asyncio.wait_for(connection,
+                                          storage.network_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._log(u"Exception: {0}".format(repr(e)))
+            return None
+
+    async def _request(self, data, wait=0):
+        # The server's answer or None. Requests the server may hold for wait
+        # seconds don't count against connections, so they can't starve the
+        # ones they wait for.
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.connections)
+        if self.storage.namespace_name is not None:
+            data = dict(data, namespace=self.storage.namespace_name)
+        payload = _storage._frame(storageservercodec.encode(data))
+        timeout = self.storage.network_timeout + float(wait)
+
+        if wait:
+            return await self._exchange(payload, timeout)
+        async with self.slots:
+            return await self._exchange(payload, timeout)
+
+    async def _exchange(self, payload, timeout):
+        # Like StorageServer._socketRequest, a pooled connection that turns
+        # out to be dead is replaced by a fresh one once.
+        for attempt in range(2):
+            fresh = not self.idle
+            if fresh:
+                connection = await self._connect()
+                if connection is None:
+                    return None
+            else:
+                connection = self.idle.pop()
+
+            reader, writer = connection
+            try:
+                writer.write(payload)
+                res = await asyncio.wait_for(self._recv(reader), timeout)
+            except (OSError, EOFError, ValueError,
+                    asyncio.TimeoutError) as e:
+                self._log(u"Except error {0}".format(repr(e)))
+                writer.close()
+                if fresh:
+                    return None
+                self._log(u"Pooled connection died, reconnecting", 2)
+                continue
+
+            if len(self.idle) < self.connections:
+                self.idle.append(connection)
+            else:
+                writer.close()
+            return self.storage._evaluate(res)
+
+        return None
+
+    async def _recv(self, reader):
+        header = await reader.readexactly(_storage._FRAME.size)
+        magic, version, flags, length = _storage._FRAME.unpack(header)
+        if magic != _storage._MAGIC or (
+                version != _storage.PROTOCOL_VERSION):
+            raise ValueError(u"Bad frame header: {0}".format(repr(header)))
+        return await reader.readexactly(length)
+
+    async def close(self):
+        # Close the pooled connections.
+        idle, self.idle = self.idle, []
+        for reader, writer in idle:
+            writer.close()
+
+    async def cacheFunction(self, funct=False, *args, **kwargs):
+        # Like StorageServer.cacheFunction, funct may be a coroutine function.
+        return await self._cacheCall(funct, args, kwargs)
+
+    def cached(self, ttl=None, version=None):
+        # Like StorageServer.cached, for coroutine functions.
+        def decorator(funct):
+            @functools.wraps(funct)
+            async def wrapper(*args, **kwargs):
+                return await self._cacheCall(funct, args, kwargs, ttl,
+                                             version)
+
+            def warm(calls, workers=2):
+                return self.warm(wrapper, calls, workers)
+
+            wrapper.warm = warm
+            return wrapper
+        return decorator
+
+    async def warm(self, funct, calls, workers=2):
+        # Like StorageServer.warm, at most workers calls at once on the event
+        # loop. Schedule it with asyncio.ensure_future to warm in background.
+        if getattr(funct, "warm", None) is None:
+            funct = functools.partial(self.cacheFunction, funct)
+        running = asyncio.Semaphore(workers)
+
+        async def call(args):
+            if not isinstance(args, (list, tuple)):
+                args = (args, )
+            async with running:
+                while not self.storage._kodiIdle():
+                    if self.storage._aborting():
+                        return
+                    await asyncio.sleep(1)
+                try:
+                    await funct(*args)
+                except Exception as e:
+                    self._log(u"Warming failed: {0}".format(repr(e)))
+
+        await asyncio.gather(*[call(args) for args in calls])
+        return len(calls)
+
+    async def _cacheCall(self, funct, args, kwargs, ttl=None, version=None):
+        storage = self.storage
+        self._log(u"function : {0} - table_name: {1}".format(repr(funct),
+                                                             repr(self.table)))
+        if funct and self.table:
+            name, timeout = storage._cacheKey(funct, args, kwargs, ttl,
+                                              version)
+            cache, failures, ret_val, stale = storage._cacheLookup(
+                name, await self.get("cache{0}".format(name)))
+            if stale:
+                self._scheduleRefresh(funct, name, args, kwargs, timeout)
+
+            if ret_val is _storage._MISSING and storage.flight_timeout:
+                ret_val = await self._awaitFlight(name)
+
+            if ret_val is _storage._MISSING:
+                self._log(u"Running: {0}".format(text(name)))
+                try:
+                    ret_val = await self._call(funct, args, kwargs)
+                except Exception:
+                    if not (storage.negative_errors and await self._setCache(
+                            cache, name, [], timeout, failures + 1)):
+                        await self._endFlight(name)
+                    raise
+                except BaseException:
+                    await self._endFlight(name)
+                    raise
+                if not await self._setCache(cache, name, ret_val, timeout):
+                    await self._endFlight(name)
+
+            return storage._cacheReturn(ret_val)
+
+        self._log(u"Error")
+        return []
+
+    async def _call(self, funct, args, kwargs):
+        ret_val = funct(*args, **kwargs)
+        if inspect.isawaitable(ret_val):
+            ret_val = await ret_val
+        return ret_val
+
+    async def _awaitFlight(self, name):
+        storage = self.storage
+        res = await self._request(storage._flightRequest(name),
+                                  storage.flight_timeout)
+        return storage._flightResult(name, res)
+
+    async def _endFlight(self, name):
+        if self.storage.flight_timeout:
+            await self._request(self.storage._landRequest(name))
+
+    def _scheduleRefresh(self, funct, name, args, kwargs, timeout):
+        # One refresh per entry, at most refresh_workers running at once.
+        if name in self.refreshing:
+            return
+        if self.refreshes is None:
+            self.refreshes = asyncio.Semaphore(self.refresh_workers)
+        self.refreshing.add(name)
+        task = asyncio.ensure_future(
+            self._refresh(funct, name, args, kwargs, timeout))
+        task.add_done_callback(lambda task: self.refreshing.discard(name))
+
+    async def _refresh(self, funct, name, args, kwargs, timeout):
+        storage = self.storage
+        async with self.refreshes:
+            if storage.flight_timeout:
+                res = await self._request(
+                    storage._flightRequest(name, wait=False))
+                if res is not None and res is not True:
+                    self._log(u"Already refreshing: {0}".format(text(name)),
+                              1)
+                    return
+
+            self._log(u"Refreshing: {0}".format(text(name)))
+            try:
+                ret_val = await self._call(funct, args, kwargs)
+            except Exception as e:
+                self._log(u"Refresh failed: {0}".format(repr(e)))
+                await self._endFlight(name)
+                return
+            if not await self._setCache({}, name, ret_val, timeout):
+                await self._endFlight(name)
+
+    async def _setCache(self, cache, name, ret_val, timeout, failures=0):
+        entry = self.storage._cacheEntry(cache, name, ret_val, timeout,
+                                         failures)
+        if entry is None:
+            return False
+        await self.set("cache{0}".format(name), *entry)
+        return True
+
+    async def cacheDelete(self, name):
+        self._log(name, 1)
+        if self.table:
+            await self._request({"action": "del", "table": self.table,
+                                 "name": "cache{0}".format(name)})
+            _storage._memory.invalidate(self.table)
+
+    async def lock(self, name, timeout=0, lease=None):
+        # Like StorageServer.lock, waiting without blocking the loop.
+        self._log(name, 1)
+        if self.table:
+            res = await self._request(
+                self.storage._lockRequest(name, timeout, lease), timeout)
+            if res == "true":
+                return True
+
+        self._log(u"Failed", 1)
+        return False
+
+    async def unlock(self, name):
+        self._log(name, 1)
+        if self.table:
+            res = await self._request(self.storage._unlockRequest(name))
+            if res == "true":
+                return True
+
+        self._log(u"Failed", 1)
+        return False
+
+    async def setMulti(self, name, data, ttl=None):
+        storage = self.storage
+        self._log(name, 1)
+        if self.table:
+            res = await self._request(
+                storage._setMultiRequest(name, data, ttl))
+            if res is not None:
+                for key in data:
+                    storage._remember(u"{0}{1}".format(name, key), data[key],
+                                      ttl)
+
+    async def getMulti(self, name, items):
+        self._log(name, 1)
+        if self.table:
+            res = await self._request(
+                {"action": "get_multi", "table": self.table, "name": name,
+                 "items": items})
+            return self.storage._multiResult(res)
+
+        return ""
+
+    async def getMultiMap(self, name, items):
+        self._log(name, 1)
+        if self.table:
+            res = await self._request(
+                {"action": "get_map", "table": self.table, "name": name,
+                 "items": items})
+            return self.storage._mapResult(items, res)
+
+        return {}
+
+    def namespace(self, name):
+        # Like StorageServer.namespace, sharing the connections.
+        namespaced = copy.copy(self)
+        namespaced.storage = self.storage.namespace(name)
+        return namespaced
+
+    async def invalidate(self, eager=False):
+        if self.table and self.storage.namespace_name is not None:
+            res = await self._request(
+                {"action": "invalidate", "table": self.table,
+                 "eager": eager})
+            _storage._memory.invalidate(self.table)
+            return res == "true"
+        return False
+
+    async def deletePrefix(self, prefix):
+        if self.table:
+            res = await self._request(
+                {"action": "del_prefix", "table": self.table,
+                 "name": prefix})
+            _storage._memory.invalidate(self.table)
+            return res == "true"
+        return False
+
+    async def delete(self, name):
+        self._log(name, 1)
+        if self.table:
+            await self._request(
+                {"action": "del", "table": self.table, "name": name})
+            _storage._memory.invalidate(self.table)
+
+    async def set(self, name, data, ttl=None):
+        self._log(name, 1)
+        if self.table:
+            res = await self._request(
+                self.storage._setRequest(name, data, ttl))
+            if res is not None:
+                self.storage._remember(name, data, ttl)
+
+    async def get(self, name):
+        storage = self.storage
+        self._log(name, 1)
+        if self.table:
+            res = storage._memoryGet(name)
+            if res is not None:
+                return res
+
+            res = storage._snapshotGet(name)
+            if res is None:
+                res = await self._request(storage._getRequest(name))
+            return storage._gotValue(name, res)
+
+        return ""
+
+    async def stats(self):
+        res = await self._request({"action": "stats"})
+        if isinstance(res, dict):
+            return res
+        return {}
+
+    def setCacheTimeout(self, timeout):
+        self.storage.setCacheTimeout(timeout)
+
+    def setStaleTimeout(self, timeout):
+        self.storage.setStaleTimeout(timeout)
+
+    def setCompression(self, method, level=6, threshold=16):
+        self.storage.setCompression(method, level, threshold)
+
+    def setFlightTimeout(self, timeout):
+        self.storage.setFlightTimeout(timeout)
+
+    def setNegativeTimeout(self, timeout, errors=False):
+        self.storage.setNegativeTimeout(timeout, errors)
+
+    def setQuota(self, megabytes):
+        self.storage.setQuota(megabytes)
@@ -16,18 +16,34 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
     Version 0.8
 '''
+import collections
+import copy
+import functools
 import hashlib
 import inspect
+import mmap
+import numbers
 import os
+import select
 import socket
 import string
+import struct
 import sys
+import tempfile
+import threading
 import time
+import uuid
+import weakref
 
 from builtins import str as text
 
 import xbmc
 
+try:
+    from . import storageservercodec
+except (ImportError, ValueError):  # imported from the module path
+    import storageservercodec
+
 try:
     import sqlite
 except:
@@ -38,8 +54,911 @@ try:
 except:
     pass
 
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+class _SelectorKey(object):
+    def __init__(self, fileobj, events, data):
+        self.fileobj = fileobj
+        self.events = events
+        self.data = data
+
+
+# Stand-in for selectors.DefaultSelector without the selectors module.
+class _SelectSelector(object):
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        key = _SelectorKey(fileobj, events, data)
+        self._keys[fileobj.fileno()] = key
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        return self.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._keys.pop(fileobj.fileno())
+
+    def select(self, timeout=None):
+        rlist = [fd for fd, key in self._keys.items()
+                 if key.events & EVENT_READ]
+        wlist = [fd for fd, key in self._keys.items()
+                 if key.events & EVENT_WRITE]
+        rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
+        ready = []
+        for fd in set(rlist) | set(wlist):
+            mask = 0
+            if fd in rlist:
+                mask |= EVENT_READ
+            if fd in wlist:
+                mask |= EVENT_WRITE
+            ready.append((self._keys[fd], mask))
+        return ready
+
+    def close(self):
+        self._keys.clear()
+
+
+def _newSelector():
+    if selectors:
+        return selectors.DefaultSelector()
+    return _SelectSelector()
+
+
+# Every table starts out as (name, data), schema 1. Each migration is the
+# list of statements that brings a table up to that schema version.
+SCHEMA_VERSION = 3
+_MIGRATIONS = [
+    (2, ["ALTER TABLE {0} ADD COLUMN expires_at real",
+         "ALTER TABLE {0} ADD COLUMN created_at real",
+         "ALTER TABLE {0} ADD COLUMN size integer",
+         "UPDATE {0} SET size = length(data) WHERE size IS NULL",
+         # Old cacheFunction results, "cache<function>|<md5>|". Nothing looks
+         # them up by these names any more, so they expire now and the
+         # sweeper removes them.
+         "UPDATE {0} SET expires_at = (julianday('now') - 2440587.5) * 86400 "
+         "WHERE expires_at IS NULL AND name LIKE 'cache%|" + "_" * 32 + "|'",
+         "CREATE INDEX IF NOT EXISTS {0}_expires ON {0} (expires_at)"]),
+    (3, ["ALTER TABLE {0} ADD COLUMN accessed_at real",
+         "UPDATE {0} SET accessed_at = created_at",
+         "CREATE INDEX IF NOT EXISTS {0}_accessed ON {0} (accessed_at)"]),
+]
+
+
+# One statement per write. ON CONFLICT needs SQLite 3.24, older versions
+# replace the whole row instead.
+_UPSERT = ("INSERT INTO {0} (name, data, expires_at, created_at, accessed_at, "
+           "size) VALUES ( %s , %s , %s , %s , %s , %s ) ON CONFLICT(name) DO "
+           "UPDATE SET data = excluded.data, "
+           "expires_at = excluded.expires_at, "
+           "created_at = excluded.created_at, "
+           "accessed_at = excluded.accessed_at, size = excluded.size")
+_REPLACE = ("INSERT OR REPLACE INTO {0} (name, data, expires_at, created_at, "
+            "accessed_at, size) VALUES ( %s , %s , %s , %s , %s , %s )")
+
+# Names per SELECT ... IN (...) of a multi get.
+_IN_BATCH = 500
+
+# Names in a namespace are namespace, separator, generation as eight hex
+# digits, separator and the name, so the names of all generations before
+# the current one sort together.
+_NAMESPACE_SEPARATOR = u"\x1f"
+
+# Locks and flights are namespaced without the generation, invalidate()
+# doesn't release them.
+_UNVERSIONED = frozenset(["lock", "unlock", "flight", "land"])
+
+# A stream is written under its name and this suffix, and renamed when it
+# is complete, so readers never see a partial value.
+_STREAM_STAGING = u"\x1e"
+
+
+def _flightKey(table, name):
+    # The flight a write of name lands, which for a namespaced name is the
+    # one of the name without its generation.
+    parts = name.split(_NAMESPACE_SEPARATOR, 2)
+    if len(parts) == 3 and len(parts[1]) == 8:
+        name = parts[0] + _NAMESPACE_SEPARATOR + parts[2]
+    return table, name
+
+
+def _prefixEnd(prefix):
+    # The smallest name after every name starting with prefix, or None
+    # when there is none. A last character that can't be incremented is
+    # dropped and the one before it incremented.
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if code == 0xD800:  # Surrogates can't be stored.
+            code = 0xE000
+        if code <= sys.maxunicode:
+            return prefix[:-1] + u"%c" % code
+        prefix = prefix[:-1]
+    return None
+
+
+# Values of the synchronous setting.
+_SYNCHRONOUS = {"0": "OFF", "1": "NORMAL", "2": "FULL"}
+
+
+def _blobBytes(data):
+    # Python 2 reads BLOBs as buffers.
+    if isinstance(data, sqlite3.Binary):
+        return bytes(data)
+    return data
+
+
+def _queryGet(curs, table, now, name):
+    curs.execute("SELECT data, expires_at FROM {0} WHERE name = ? AND "
+                 "(expires_at IS NULL OR expires_at > ?)".format(table),
+                 (name, now))
+    return [(_blobBytes(data), expires_at)
+            for data, expires_at in curs.fetchall()]
+
+
+def _queryMap(curs, table, now, names):
+    # Stay well below SQLite's limit on the number of parameters.
+    rows = []
+    for start in range(0, len(names), _IN_BATCH):
+        batch = names[start:start + _IN_BATCH]
+        curs.execute(
+            "SELECT name, data, expires_at FROM {0} WHERE name IN ({1}) "
+            "AND (expires_at IS NULL OR expires_at > ?)".format(
+                table, ", ".join(["?"] * len(batch))),
+            tuple(batch) + (now,))
+        rows.extend((name, _blobBytes(data), expires_at)
+                    for name, data, expires_at in curs.fetchall())
+    return rows
+
+
+# Reads of fewer names than this aren't worth handing to a reader thread.
+_READER_MIN = 50
+
+# Values of the compression setting.
+_COMPRESSION = {"1": "zlib", "2": "lzma"}
+
+# Returned by a command whose answer the server sends later, see reply().
+_DEFERRED = object()
+# cacheFunction has no result, unlike a cached empty one.
+_MISSING = object()
+
+
+def _megabytes(value):
+    try:
+        return int(float(value) * 1024 * 1024)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _remaining(expires_at, now):
+    if expires_at is None or expires_at == float("inf"):
+        return None
+    return expires_at - now
+
+
+def _tableName(table):
+    # Table names go into SQL, so only letters and digits are kept.
+    return ''.join(c for c in table if
+                   c in "{0}{1}".format(string.ascii_letters, string.digits))
+
+
+def _dataSize(data):
+    try:
+        return len(data)
+    except TypeError:
+        return len(repr(data))
+
+
+# cacheFunction keys: the qualified name of the function and a hash of a
+# canonical encoding of its arguments, the same in every process.
+_keyHash = getattr(hashlib, "blake2b", None)
+_qualifiedNames = weakref.WeakKeyDictionary()
+# Arguments that don't change the result, like callbacks.
+_KEY_IGNORED = ("new_results_function",)
+
+
+def _newKeyHash():
+    if _keyHash is not None:
+        return _keyHash(digest_size=16)
+    return hashlib.md5()  # Python 2
+
+
+def _qualifiedName(funct):
+    # Bound methods are new objects on every access, their function isn't.
+    # Python 2 only knows a method's class from the method.
+    owner = getattr(funct, "im_self", None)
+    if not inspect.isclass(owner):  # Not a classmethod.
+        owner = getattr(funct, "im_class", None)
+    funct = getattr(funct, "__func__", funct)
+    try:
+        return _qualifiedNames[funct]
+    except (KeyError, TypeError):
+        pass
+
+    name = getattr(funct, "__qualname__", None)
+    if name is None:
+        name = getattr(funct, "__name__", None) or repr(funct)
+        if owner is not None:
+            # The class defining it, like __qualname__.
+            for cls in inspect.getmro(owner):
+                member = vars(cls).get(name)
+                if getattr(member, "__func__", member) is funct:
+                    owner = cls
+                    break
+            name = u"{0}.{1}".format(owner.__name__, name)
+    module = getattr(funct, "__module__", None)
+    if module:
+        name = u"{0}.{1}".format(module, name)
+    try:
+        _qualifiedNames[funct] = name
+    except TypeError:  # Builtins can't be weakly referenced.
+        pass
+    return name
+
+
+def _encodeKey(obj, out):
+    # Tag, length and value, so different arguments never encode alike.
+    if obj is None or obj is True or obj is False:
+        out.append(b"N" if obj is None else b"T" if obj else b"F")
+    elif isinstance(obj, numbers.Integral):
+        out.append(u"i{0};".format(int(obj)).encode('ascii'))
+    elif isinstance(obj, float):
+        out.append(u"f{0};".format(repr(obj)).encode('ascii'))
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(u"b{0}:".format(len(obj)).encode('ascii'))
+        out.append(bytes(obj))
+    elif isinstance(obj, (text, type(u""))):
+        data = obj.encode('utf-8')
+        out.append(u"s{0}:".format(len(data)).encode('ascii'))
+        out.append(data)
+    elif isinstance(obj, (list, tuple)):
+        tag = u"l" if isinstance(obj, list) else u"t"
+        out.append(u"{0}{1}:".format(tag, len(obj)).encode('ascii'))
+        for item in obj:
+            _encodeKey(item, out)
+    elif isinstance(obj, dict):
+        _encodeItems(obj.items(), out)
+    elif isinstance(obj, (set, frozenset)):
+        items = []
+        for item in obj:
+            encoded = []
+            _encodeKey(item, encoded)
+            items.append(b"".join(encoded))
+        out.append(u"e{0}:".format(len(items)).encode('ascii'))
+        out.extend(sorted(items))
+    elif callable(obj):
+        _encodeKey(_qualifiedName(obj), out)
+    else:
+        _encodeKey(repr(obj), out)
+
+
+def _encodeItems(items, out):
+    # Keys of any type, sorted by their encoding.
+    pairs = []
+    for key, value in items:
+        if key in _KEY_IGNORED:
+            continue
+        encoded = []
+        _encodeKey(key, encoded)
+        pairs.append((b"".join(encoded), value))
+    pairs.sort(key=lambda pair: pair[0])
+    out.append(u"d{0}:".format(len(pairs)).encode('ascii'))
+    for key, value in pairs:
+        out.append(key)
+        _encodeKey(value, out)
+
+
+# Wire protocol 2: every message is a frame header followed by the payload.
+PROTOCOL_VERSION = 2
+_MAGIC = b"SC"
+_FRAME = struct.Struct("!2sBBI")
+
+
+def _frame(payload):
+    if isinstance(payload, text):
+        payload = payload.encode('utf-8')
+    return _FRAME.pack(_MAGIC, PROTOCOL_VERSION, 0, len(payload)) + payload
+
+
+# One client connection on the server. Protocol 2 clients open with the
+# frame magic and send length prefixed frames, anything else is an old
+# client sending ACKed chunks. All of it non-blocking.
+class _ClientConnection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.framed = None
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.payload = None
+        self.view = None
+        self.got = 0
+        self.chunk = 0
+        self.pending = None
+        self.held = []
+        self.deferred = None
+        self.queued = []
+        self.closing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def readable(self):
+        if self.payload is not None:
+            received = self.sock.recv_into(self.view[self.got:])
+            if not received:
+                return False
+            self.got += received
+            if self.got == len(self.payload):
+                payload = bytes(self.payload)
+                self.payload = self.view = None
+                self._request(payload)
+            return True
+
+        data = self.sock.recv(65536)
+        if not data:
+            return False
+
+        self.inbuf += data
+        if self.framed is None:
+            if len(self.inbuf) < len(_MAGIC):
+                return True
+            self.framed = self.inbuf.startswith(_MAGIC)
+            self.server._log("protocol {0}".format(
+                PROTOCOL_VERSION if self.framed else 1), 3)
+
+        if self.framed:
+            self._frames()
+            return True
+        return self._legacy(len(data))
+
+    def writable(self):
+        if self.outbuf:
+            sent = self.sock.send(self.outbuf)
+            del self.outbuf[:sent]
+        return not (self.closing and not self.outbuf)
+
+    def _frames(self):
+        while len(self.inbuf) >= _FRAME.size:
+            magic, version, flags, length = _FRAME.unpack_from(
+                bytes(self.inbuf[:_FRAME.size]))
+            if magic != _MAGIC or version != PROTOCOL_VERSION:
+                raise ValueError("Bad frame header: {0}".format(
+                    repr(bytes(self.inbuf[:_FRAME.size]))))
+
+            end = _FRAME.size + length
+            if len(self.inbuf) >= end:
+                payload = bytes(self.inbuf[_FRAME.size:end])
+                del self.inbuf[:end]
+                self._request(payload)
+            else:
+                # Receive the rest straight into a buffer of the final size.
+                self.payload = bytearray(length)
+                self.got = len(self.inbuf) - _FRAME.size
+                self.payload[:self.got] = self.inbuf[_FRAME.size:]
+                self.view = memoryview(self.payload)
+                self.inbuf = bytearray()
+                return
+
+    def _request(self, payload):
+        # Requests arriving while an answer is deferred wait their turn.
+        if self.deferred is not None:
+            self.queued.append(payload)
+            return
+
+        # Answer in the codec the client used.
+        codec = storageservercodec.codecOf(payload)
+        writes = self.server.writes
+        res = self._runCommand(payload)
+        if res is _DEFERRED:
+            self.deferred = codec
+            return
+        self._answer(storageservercodec.encode(res, codec),
+                     self.server.writes != writes)
+
+    def reply(self, res, wrote=True):
+        # Answer the deferred request, then run the ones queued behind it.
+        codec, self.deferred = self.deferred, None
+        self._answer(storageservercodec.encode(res, codec), wrote)
+        queued, self.queued = self.queued, []
+        for payload in queued:
+            self._request(payload)
+
+    def _answer(self, data, wrote):
+        # A write is acknowledged once it is committed, and later answers
+        # on this connection queue up behind it.
+        frame = _frame(data)
+        if self.held or (wrote and self.server.uncommitted is not None):
+            self.held.append(frame)
+            self.server.held.add(self)
+        else:
+            self.outbuf += frame
+
+    def release(self):
+        for frame in self.held:
+            self.outbuf += frame
+        self.held = []
+
+    def _runCommand(self, data):
+        # Only protocol 2 clients can wait for a deferred answer.
+        self.server.requester = self if self.framed else None
+        try:
+            return self.server._runCommand(self.server._recieveData(data))
+        except Exception as e:
+            self.server._log("Exception: {0}".format(repr(e)))
+            return ""
+
+    def _status(self, status):
+        status = u"{0}\r\n".format(status)
+        self.outbuf += u"{0}{1}".format(
+            status, u" " * (15 - len(status))).encode('utf-8')
+
+    def _legacy(self, received):
+        if self.pending is None:
+            self.chunk += received
+            if self.inbuf.endswith(b"\r\n"):
+                self._status(u"COMPLETE")
+                data = bytes(self.inbuf).strip()
+                self.inbuf = bytearray()
+                self._legacyRequest(data)
+            elif self.chunk >= self.server.network_buffer_size:
+                self._status(u"ACK")
+                self.chunk = 0
+            return True
+
+        # While a response is going out inbuf collects the client's status.
+        if self.pending:
+            if (self.inbuf.find(b"ACK\r\n") > -1 or
+                    self.inbuf.find(b"COMPLETE\r\n") > -1):
+                self.inbuf = bytearray()
+                self.outbuf += self.pending.pop(0)
+        elif self.inbuf.find(b"COMPLETE\r\n") > -1:
+            return False
+        return True
+
+    def _legacyRequest(self, data):
+        res = self._runCommand(data)
+        if len(res) > 0:
+            size = self.server.network_buffer_size
+            res = repr(res).encode('utf-8')
+            self.pending = [res[i:i + size]
+                            for i in range(0, len(res), size)]
+            self.pending[-1] += b"\r\n"
+            self.outbuf += self.pending.pop(0)
+        else:
+            self.closing = True
+
+
+# A request of a thread in the server's own process, answered like a
+# socket client's while the thread waits on event.
+class _LocalRequest(object):
+    def __init__(self, server, data):
+        self.server = server
+        self.data = data
+        self.res = None
+        self.event = threading.Event()
+
+    def run(self):
+        writes = self.server.writes
+        self.server.requester = self
+        try:
+            res = self.server._runCommand(self.data)
+        except Exception as e:
+            self.server._log("Exception: {0}".format(repr(e)))
+            res = ""
+        if res is not _DEFERRED:
+            self._answer(res, self.server.writes != writes)
+
+    def reply(self, res, wrote=True):
+        self._answer(res, wrote)
+
+    def release(self):
+        self.event.set()
+
+    def _answer(self, res, wrote):
+        self.res = res
+        if wrote and self.server.uncommitted is not None:
+            self.server.held.add(self)
+        else:
+            self.event.set()
+
+
+# Requests of clients in the server's process, queued for the server
+# loop without encoding or sockets. The loop is woken through a
+# socket pair, so only its thread uses the database.
+class _LocalTransport(object):
+    def __init__(self, server):
+        self.server = server
+        self.queue = collections.deque()
+        self.wake, self.waker = socket.socketpair()
+        self.wake.setblocking(0)
+        self.waker.setblocking(0)
+
+    def request(self, data, timeout):
+        request = _LocalRequest(self.server, data)
+        self.queue.append(request)
+        try:
+            self.waker.send(b"\0")
+        except socket.error:
+            pass  # The buffer is full of wake-ups already.
+        if request.event.wait(timeout):
+            return request.res
+        return None
+
+    def run(self):
+        try:
+            self.wake.recv(4096)
+        except socket.error:
+            pass
+        while self.queue:
+            self.queue.popleft().run()
+
+    def close(self):
+        # Whoever is still queued gets no answer.
+        while self.queue:
+            self.queue.popleft().release()
+        self.wake.close()
+        self.waker.close()
+
+
+# Threads with a read-only connection each, reading the last commit
+# under WAL while the loop stays the only writer. Callbacks run back
+# on the loop.
+class _ReaderPool(object):
+    def __init__(self, server, size):
+        self.server = server
+        self.jobs = queue.Queue()
+        self.done = collections.deque()
+        self.wake, self.waker = socket.socketpair()
+        self.wake.setblocking(0)
+        self.waker.setblocking(0)
+        self.workers = []
+        for i in range(size):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, query, args, callback):
+        self.jobs.put((query, args, callback))
+
+    def run(self):
+        try:
+            self.wake.recv(4096)
+        except socket.error:
+            pass
+        while self.done:
+            callback, res = self.done.popleft()
+            callback(res)
+
+    def close(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join(5)
+        self.run()
+        self.wake.close()
+        self.waker.close()
+
+    def _connect(self):
+        path = self.server.path
+        try:
+            return sqlite3.connect(
+                u"file:{0}?mode=ro".format(path.replace("?", "%3f")),
+                uri=True, check_same_thread=False)
+        except TypeError:  # No URI filenames before Python 3.4.
+            return sqlite3.connect(path, check_same_thread=False)
+
+    def _work(self):
+        conn = self._connect()
+        curs = conn.cursor()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            query, args, callback = job
+            try:
+                res = query(curs, *args)
+            except Exception as e:
+                res = e
+            self.done.append((callback, res))
+            try:
+                self.waker.send(b"\0")
+            except socket.error:
+                pass  # The buffer is full of wake-ups already.
+        conn.close()
+
+
+# Idle protocol 2 connections shared by every client in the process.
+# Idle ones that became readable were closed by the server and are
+# dropped.
+class _ConnectionPool(object):
+    def __init__(self, size=8):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self):
+        self._checkFork()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                sock = self._idle.pop()
+            if self._healthy(sock):
+                return sock
+            sock.close()
+
+    def release(self, sock):
+        self._checkFork()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+    def _checkFork(self):
+        # A forked child must not share the parent's connections, answers
+        # would go to whichever process reads first. The lock may have been
+        # held by a thread that doesn't exist in the child.
+        if self._pid != os.getpid():
+            idle, self._idle = self._idle, []
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            for sock in idle:
+                sock.close()
+
+    def _healthy(self, sock):
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+
+_pool = _ConnectionPool()
+
+# Locks belong to a process, whichever of its StorageServers took them. The
+# pid tells a forked child, which inherits the uuid, from its parent.
+_PROCESS = uuid.uuid4().hex
+
+
+def _lockOwner():
+    return u"{0}.{1}".format(_PROCESS, os.getpid())
+
+
+# Bounded LRU keyed by (table, name). Clients keep entries for ttl
+# seconds since other processes may change them, the server keeps hot
+# rows without one since every write goes through it.
+class _MemoryCache(object):
+    def __init__(self, entries=1000, size=8 * 1024 * 1024, ttl=10):
+        self.entries = entries
+        self.size = size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        item = self.lookup(key)
+        return None if item is None else item[0]
+
+    def lookup(self, key):
+        # The value of key and the seconds it has left, None for ever, or
+        # None when key isn't cached.
+        now = time.time()
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            if item[1] < now:
+                self._used -= item[2]
+                return None
+            self._items[key] = item
+            return item[0], _remaining(item[1], now)
+
+    def set(self, key, value, ttl=None):
+        size = _dataSize(value)
+        ttls = [limit for limit in (ttl, self.ttl) if limit is not None]
+        expires = time.time() + min(ttls) if ttls else float("inf")
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self._used -= item[2]
+            if size > self.size // 4:
+                return
+            self._items[key] = (value, expires, size)
+            self._used += size
+            while len(self._items) > self.entries or self._used > self.size:
+                self._used -= self._items.popitem(last=False)[1][2]
+
+    def discard(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self._used -= item[2]
+
+    def invalidate(self, table):
+        with self._lock:
+            for key in [key for key in self._items if key[0] == table]:
+                self._used -= self._items.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._used = 0
+
+
+_memory = _MemoryCache()
+
+
+# Snapshot file: header, hash index of slots, then the entries. A slot is
+# the 64 bit hash of an entry's key and the entry's offset, 0 when empty.
+# The key of an entry is table, NUL, name in UTF-8, its value is UTF-8
+# text or bytes, and an expires_at of 0 is never.
+_SNAPSHOT_MAGIC = b"SCSNAP1\0"
+_SNAPSHOT_HEADER = struct.Struct("!8sddII")  # magic, built, valid, slots, n
+_SNAPSHOT_VALID = 16  # Offset of valid in the header.
+_SNAPSHOT_SLOT = struct.Struct("!QQ")
+_SNAPSHOT_ENTRY = struct.Struct("!IIdB")  # key, value size, expires, binary
+
+
+class _Spool(object):
+    # A streamed value in a temporary file, for servers without incremental
+    # BLOB I/O.
+    def __init__(self, directory, generation=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.generation = generation
+        self.used = time.time()
+
+    def close(self):
+        self.file.close()
+
+
+def _snapshotKey(table, name):
+    key = u"{0}\0{1}".format(table, name).encode('utf-8')
+    return key, struct.unpack("!Q", hashlib.md5(key).digest()[:8])[0]
+
+
+# The snapshot file mapped read-only by clients. A rebuilt file is
+# noticed within a second, a zeroed valid field right away.
+class _SnapshotReader(object):
+    def __init__(self):
+        self.map = None
+        self.ident = None
+        self.checked = 0
+
+    def get(self, path, table, name):
+        # The value of name and the seconds it has left, like the server's
+        # answer to get, or None when it isn't in a valid snapshot.
+        now = time.time()
+        if now - self.checked >= 1:
+            self.checked = now
+            self._open(path)
+
+        snapshot = self.map
+        if snapshot is None:
+            return None
+        magic, built, valid, slots, count = _SNAPSHOT_HEADER.unpack_from(
+            snapshot, 0)
+        if magic != _SNAPSHOT_MAGIC or valid < now or not slots:
+            return None
+
+        key, keyhash = _snapshotKey(table, name)
+        slot = keyhash & (slots - 1)
+        while True:
+            slothash, offset = _SNAPSHOT_SLOT.unpack_from(
+                snapshot, _SNAPSHOT_HEADER.size + slot * _SNAPSHOT_SLOT.size)
+            if not offset:
+                return None
+            if slothash == keyhash:
+                keysize, size, expires_at, binary = (
+                    _SNAPSHOT_ENTRY.unpack_from(snapshot, offset))
+                start = offset + _SNAPSHOT_ENTRY.size
+                if snapshot[start:start + keysize] == key:
+                    if expires_at and expires_at <= now:
+                        return None
+                    value = snapshot[start + keysize:start + keysize + size]
+                    return [value if binary else value.decode('utf-8'),
+                            _remaining(expires_at or None, now)]
+            slot = (slot + 1) & (slots - 1)
+
+    def _open(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.map = self.ident = None
+            return
+
+        ident = (stat.st_ino, stat.st_size, stat.st_ctime)
+        if ident == self.ident:
+            return
+        try:
+            with open(path, "rb") as snapshot:
+                self.map = mmap.mmap(snapshot.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            self.ident = ident
+        except (IOError, OSError, ValueError):
+            self.map = self.ident = None
+
+
+_snapshot = _SnapshotReader()
+
+
+# Background cacheFunction calls, one per key at a time, on at most
+# workers threads that end when the queue is empty.
+class _RefreshPool(object):
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.running = 0
+        self.keys = set()
+        self.queue = collections.deque()
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+            self.queue.append((key, func, args))
+            if self.running >= self.workers:
+                return True
+            self.running += 1
+        threading.Thread(target=self._work).start()
+        return True
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self.queue:
+                    self.running -= 1
+                    return
+                key, func, args = self.queue.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                xbmc.log(u"StorageServer background call failed: {0}".format(
+                    repr(e)))
+            finally:
+                with self._lock:
+                    self.keys.discard(key)
+
+
+_refresher = _RefreshPool()
+
 
 class StorageServer():
+    upsert = _UPSERT
+    # Seconds a lock is held when the client doesn't ask for a lease.
+    lock_lease = 600
+    # Call a server running in this process directly, not over the socket.
+    local_dispatch = True
+    # Look up get() in the snapshot file before asking the server.
+    snapshot_reads = True
+    # Most seconds a failing cacheFunction call is backed off, see
+    # setNegativeTimeout.
+    error_backoff = 3600
+    # Seconds without user input before warm() makes each call.
+    warm_idle = 5
+
     def __init__(self, table=None, timeout=24, instance=False):
         self.version = u"2.5.4"
         self.plugin = u"StorageClient-{0}".format(self.version)
@@ -86,7 +1005,7 @@ class StorageServer():
         self.path = os.path.join(self.path, 'commoncache.db')
 
         self.socket = ""
-        self.clientsocket = False
+        self.clients = set()
         self.sql2 = False
         self.sql3 = False
         self.abortRequested = False
@@ -99,17 +1018,51 @@ class StorageServer():
         self.platform = sys.platform
         self.modules = sys.modules
         self.network_buffer_size = 4096
+        self.network_timeout = 10
+        self.sweep_batch = 500
+        self.commit_window = 0.05
+        self.uncommitted = None
+        self.writes = 0
+        self.held = set()
+        self.selector = None
+        self.requester = None
+        self.waiters = {}
+        self.flights = {}
+        self.next_wake = None
+        self.flight_timeout = 30
+        self.stale = 0
+        self.negative_timeout = 0
+        self.negative_errors = False
+        self.snapshot_interval = 5
+        self.maintenance_interval = 1
+        self.snapshot_valid = False
+        self.spool_timeout = 60
+        self.next_snapshot = 0
+        self.readers = None
+        self.generations = {}
+        self.changed = set()
+        self.quota = None
+        self.namespace_name = None
+        self.counters = {"expired": 0, "reclaimed_bytes": 0, "evicted": 0,
+                         "hot_hits": 0, "hot_misses": 0, "invalidated": 0}
 
         if isinstance(table, str) and len(table) > 0:
-            self.table = ''.join(c for c in table if
-                                 c in "{0}{1}".format(string.ascii_letters,
-                                                      string.digits))
+            self.table = _tableName(table)
             self._log("Setting table to : {0}".format(self.table))
         elif table != False:  # noqa E712
             self._log("No table defined")
 
         self.setCacheTimeout(timeout)
 
+        if StorageServer.memory_cache is None:
+            StorageServer.memory_cache = (
+                self.settings.getSetting("memory_cache") != "false")
+
+        self.setCompression(
+            _COMPRESSION.get(self.settings.getSetting("compression")),
+            self.settings.getSetting("compression_level") or 6,
+            self.settings.getSetting("compression_threshold") or 16)
+
     def _startDB(self):
         try:
             if "sqlite3" in self.modules:
@@ -125,6 +1078,54 @@ class StorageServer():
                 return False
 
             self.curs = self.conn.cursor()
+            if self.sql3:
+                if self._pragma("auto_vacuum") != 2:
+                    # The sweeper gives space back with incremental vacuum.
+                    # A new file takes the setting as it is, an existing one
+                    # is rebuilt once, before any client is served.
+                    self._log("Enabling incremental vacuum")
+                    new = not self._pragma("page_count")
+                    self.curs.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                    if not new:
+                        self.curs.execute("VACUUM")
+                self.curs.execute("PRAGMA journal_mode = WAL")
+                self.curs.execute("PRAGMA synchronous = {0}".format(
+                    _SYNCHRONOUS.get(self.settings.getSetting("synchronous"),
+                                     "NORMAL")))
+                if sqlite3.sqlite_version_info < (3, 24, 0):
+                    self.upsert = _REPLACE
+            # Incremental BLOB I/O needs Python 3.11.
+            self.blob_io = hasattr(self.conn, "blobopen")
+            self.tables = set()
+            self.sizes = {}
+            self.accessed = {}
+            self.spools = {}
+            self.hot = _MemoryCache(
+                entries=10000, ttl=None,
+                size=_megabytes(self.settings.getSetting("hot_cache") or 4))
+            self.curs.execute("CREATE TABLE IF NOT EXISTS cache_schema "
+                              "(name text unique, version integer)")
+            self.curs.execute("CREATE TABLE IF NOT EXISTS cache_locks "
+                              "(tbl text, name text, owner text, "
+                              "expires_at real, PRIMARY KEY (tbl, name))")
+            self.curs.execute("CREATE TABLE IF NOT EXISTS cache_snapshots "
+                              "(tbl text, name text, PRIMARY KEY (tbl, name))")
+            self.curs.execute("SELECT tbl, name FROM cache_snapshots")
+            self.published = {}
+            for table, name in self.curs.fetchall():
+                self.published.setdefault(table, set()).add(name)
+            self.curs.execute("CREATE TABLE IF NOT EXISTS cache_namespaces "
+                              "(tbl text, namespace text, generation integer, "
+                              "reclaimed integer, "
+                              "PRIMARY KEY (tbl, namespace))")
+            self.curs.execute("SELECT tbl, namespace, generation, reclaimed "
+                              "FROM cache_namespaces")
+            self.namespaces = dict(((row[0], row[1]), [row[2], row[3]])
+                                   for row in self.curs.fetchall())
+            # A snapshot left by an earlier server may be older than the
+            # database, don't serve from it until it is rebuilt.
+            self._invalidateSnapshot()
+            self._commit()
             return True
         except Exception as e:
             self._log("Exception: {0}".format(repr(e)))
@@ -140,42 +1141,43 @@ class StorageServer():
         return False
 
     def _usePosixSockets(self):
-        if self.platform in ["win32", 'win10'] or any(
-                xbmc.getCondVisibility('system.platform.android'),
-                xbmc.getCondVisibility('system.platform.ios'),
-                xbmc.getCondVisibility('system.platform.tvos')):
-            return False
-        else:
-            return True
+        # The platform can't change, so decide once per process.
+        if StorageServer._posix_sockets is None:
+            StorageServer._posix_sockets = not (
+                self.platform in ["win32", 'win10'] or any([
+                    xbmc.getCondVisibility('system.platform.android'),
+                    xbmc.getCondVisibility('system.platform.ios'),
+                    xbmc.getCondVisibility('system.platform.tvos')]))
+        return StorageServer._posix_sockets
 
     def _sock_init(self, check_stale=False):
         self._log("", 2)
-        if not self.socket or check_stale:
+        if not StorageServer._address or check_stale:
             self._log("Checking", 4)
 
             if self._usePosixSockets():
                 self._log("POSIX", 4)
-                self.socket = os.path.join(
-                    self.xbmc.translatePath('special://temp/').decode("utf-8"),
-                    'commoncache.socket')
-                if self.xbmcvfs.exists(self.socket) and check_stale:
-                    self._log(
-                        "Deleting stale socket file : {0}".format(self.socket))
-                    self.xbmcvfs.delete(self.socket)
+                StorageServer._address = os.path.join(
+                    os.path.dirname(self.path), 'commoncache.socket')
+                if (self.xbmcvfs.exists(StorageServer._address) and
+                        check_stale):
+                    self._log("Deleting stale socket file : {0}".format(
+                        StorageServer._address))
+                    self.xbmcvfs.delete(StorageServer._address)
             else:
                 self._log("Non-POSIX", 4)
                 port = self.settings.getSetting("port")
-                self.socket = ("127.0.0.1", int(port))
+                StorageServer._address = ("127.0.0.1", int(port))
 
+        self.socket = StorageServer._address
         self._log("Done: {0}".format(repr(self.socket)), 2)
 
-    def _recieveData(self):
+    def _recieveData(self, data):
         self._log("", 3)
-        data = self._recv(self.clientsocket)
         self._log("received data: {0}".format(repr(data)), 4)
 
         try:
-            data = eval(data)
+            data = storageservercodec.decode(data)
         except:
             self._log("Couldn't evaluate message : {0}".format(repr(data)))
             data = {"action": "stop"}
@@ -187,28 +1189,88 @@ class StorageServer():
     def _runCommand(self, data):
         self._log("", 3)
         res = ""
+        if data.get("quota") is not None:
+            self.quotas[data["table"]] = _megabytes(data["quota"])
+        if data.get("namespace") is not None and data.get("name") is not None:
+            if data["action"] in _UNVERSIONED:
+                name = data["namespace"] + _NAMESPACE_SEPARATOR + data["name"]
+            else:
+                name = self._namespaced(data["table"], data["namespace"],
+                                        data["name"])
+            data = dict(data, name=name)
+
         if data["action"] == "get":
-            res = self._sqlGet(data["table"], data["name"])
+            res = self._sqlGet(data["table"], data["name"],
+                               data.get("remaining"))
         elif data["action"] == "get_multi":
             res = self._sqlGetMulti(data["table"], data["name"], data["items"])
+        elif data["action"] == "get_map":
+            res = self._sqlGetMap(data["table"], data["name"], data["items"])
         elif data["action"] == "set_multi":
-            res = self._sqlSetMulti(data["table"], data["name"], data["data"])
+            res = self._sqlSetMulti(data["table"], data["name"], data["data"],
+                                    data.get("ttl"))
         elif data["action"] == "set":
-            res = self._sqlSet(data["table"], data["name"], data["data"])
+            res = self._sqlSet(data["table"], data["name"], data["data"],
+                               data.get("ttl"))
         elif data["action"] == "del":
             res = self._sqlDel(data["table"], data["name"])
+        elif data["action"] == "del_prefix":
+            res = self._sqlDelPrefix(data["table"], data["name"])
+        elif data["action"] == "invalidate":
+            res = self._invalidate(data["table"], data["namespace"],
+                                   data.get("eager", False))
+        elif data["action"] == "clean":
+            res = self._sqlClean(data["table"], data["empty"])
+        elif data["action"] == "stats":
+            res = dict(self.counters)
+        elif data["action"] == "batch":
+            # Operations of a batch are answered together, right away.
+            requester, self.requester = self.requester, None
+            res = [self._batchOperation(operation)
+                   for operation in data["operations"]]
+            self.requester = requester
         elif data["action"] == "lock":
-            res = self._lock(data["table"], data["name"])
+            res = self._lock(data["table"], data["name"], data.get("owner"),
+                             data.get("lease"), data.get("timeout"))
         elif data["action"] == "unlock":
-            res = self._unlock(data["table"], data["name"])
-
-        if len(res) > 0:
+            res = self._unlock(data["table"], data["name"], data.get("owner"))
+        elif data["action"] == "read_stream":
+            res = self._readStream(data["table"], data["name"],
+                                   data["offset"], data["size"])
+        elif data["action"] == "write_stream":
+            res = self._writeStream(data["table"], data["name"], data["data"],
+                                    data["offset"], data["size"],
+                                    data.get("ttl"), data.get("final"))
+        elif data["action"] == "snapshot":
+            res = self._publish(data["table"], data.get("name") or "",
+                                data.get("enabled", True))
+        elif data["action"] == "flight":
+            res = self._flight(data["table"], data["name"], data["timeout"],
+                               data.get("wait", True))
+        elif data["action"] == "land":
+            res = self._land((data["table"], data["name"]), "")
+
+        if res is not _DEFERRED and res:
             self._log(
-                "Got response: {0} - {1}".format(str(len(res)),
+                "Got response: {0} - {1}".format(str(len(repr(res))),
                                                  str(repr(res))[0:50]), 3)
-            self._send(self.clientsocket, repr(res))
 
         self._log("Done", 3)
+        return res
+
+    def _batchOperation(self, data):
+        # Every operation of a batch runs in the same transaction, a
+        # failing one only fails itself.
+        if data.get("action") == "batch":
+            return None
+        if data.get("action") == "flight":
+            return None
+        data.pop("timeout", None)  # A batch can't wait for a lock.
+        try:
+            return self._runCommand(data)
+        except Exception as e:
+            self._log("Exception: {0}".format(repr(e)))
+            return None
 
     def _showMessage(self, heading, message):
         self._log("{0} - {1}".format(repr(type(heading)), repr(type(message))))
@@ -239,48 +1301,121 @@ class StorageServer():
 
             return False
 
-        sock.listen(1)
+        sock.listen(socket.SOMAXCONN)
         sock.setblocking(0)
 
+        selector = _newSelector()
+        selector.register(sock, EVENT_READ, None)
+        self.selector = selector
+
+        local = None
+        if hasattr(socket, "socketpair"):
+            local = _LocalTransport(self)
+            selector.register(local.wake, EVENT_READ, local)
+            StorageServer._local = local
+
+            readers = int(self.settings.getSetting("readers") or 2)
+            if readers > 0 and self.sql3:
+                self.readers = _ReaderPool(self, readers)
+                selector.register(self.readers.wake, EVENT_READ, self.readers)
+
+        self.sweeper = None
+        self.next_maintenance = 0
+        # A cleanup setting of 0 turns the sweep off.
+        cleanup = int(self.settings.getSetting("cleanup") or 10)
+        self.sweep_interval = 60 * cleanup if cleanup > 0 else float("inf")
+        self.next_sweep = time.time() + (60 if cleanup > 0 else float("inf"))
+        self.quotas = {}
+        self.db_quota = _megabytes(self.settings.getSetting("quota"))
+
         idle_since = time.time()
-        waiting = 0
+        sleeping = False
         while not self._aborting():
-            if waiting == 0:
-                self._log("accepting", 3)
-                waiting = 1
+            if self.sweeper or self.uncommitted is not None:
+                timeout = 0.0
+            elif sleeping:
+                timeout = 1.0
+            else:
+                timeout = max(0.0, min(1.0, idle_since + self.idle -
+                                       time.time()))
+            if self.next_wake is not None:
+                timeout = max(0.0, min(timeout, self.next_wake - time.time()))
+
             try:
-                (self.clientsocket, address) = sock.accept()
-                if waiting == 2:
-                    self._log("Waking up, slept for {0} seconds.".format(
-                        int(time.time() - idle_since)))
-                waiting = 0
-            except socket.error as e:
-                if e.errno == 11 or e.errno == 10035 or e.errno == 35:
-                    # There has to be a better way to accomplish this.
-                    if idle_since + self.idle < time.time():
-                        if self.instance:
-                            self.die = True
-                        if waiting == 1:
-                            self._log(
-                                "Idle for {0} seconds. Going to sleep. "
-                                "zzzzzzzz ".format(self.idle))
-                        time.sleep(0.5)
-                        waiting = 2
-                    continue
-            except:
-                pass
+                events = selector.select(timeout)
+            except (select.error, socket.error, OSError) as e:
+                self._log("Select error: {0}".format(repr(e)))
+                continue
 
-            if waiting:
-                self._log("Continue : {0}".format(repr(waiting)), 3)
+            if (self.next_wake is not None and
+                    self.next_wake <= time.time()):
+                self._wakeWaiters()
+
+            if not events:
+                if self.uncommitted is not None:
+                    # The burst of requests is over, commit it in one go.
+                    self._commit()
+                    continue
+                self._maintenance()
+                # Pooled client connections stay open, so idle means no
+                # traffic rather than no clients.
+                if not sleeping and idle_since + self.idle < time.time():
+                    if self.instance:
+                        self.die = True
+                    self._log("Idle for {0} seconds. Going to sleep. "
+                              "zzzzzzzz ".format(self.idle))
+                    sleeping = True
                 continue
 
-            data = self._recieveData()
-            self._runCommand(data)
+            if sleeping:
+                self._log("Waking up, slept for {0} seconds.".format(
+                    int(time.time() - idle_since)))
+                sleeping = False
+
+            for key, mask in events:
+                if key.data is None:
+                    self._acceptClients(sock, selector)
+                elif key.data is local:
+                    local.run()
+                elif key.data is self.readers:
+                    self.readers.run()
+                else:
+                    self._serviceClient(selector, key.data, mask)
             idle_since = time.time()
 
-            self._log("Done")
+            if (self.uncommitted is not None and
+                    idle_since - self.uncommitted >= self.commit_window):
+                self._commit()
+            if idle_since >= self.next_maintenance:
+                # Steady traffic never leaves select() with nothing to do.
+                self._maintenance()
 
         self._log("Closing down")
+        if local:
+            StorageServer._local = None
+            local.run()
+        for waiters in self.waiters.values():
+            for deadline, client, owner, lease in waiters:
+                client.reply("false")
+        self.waiters = {}
+        for key in list(self.flights):
+            self._land(key, "")
+        if self.uncommitted is not None:
+            self._commit()
+        for key in list(self.spools):
+            self._closeSpool(key)
+        # Nothing keeps the snapshot up to date any more.
+        self._invalidateSnapshot()
+        for client in list(self.clients):
+            self._closeClient(selector, client)
+        if local:
+            selector.unregister(local.wake)
+            local.close()
+        if self.readers:
+            readers, self.readers = self.readers, None
+            selector.unregister(readers.wake)
+            readers.close()
+        selector.close()
         sock.close()
 
         if self._usePosixSockets():
@@ -289,210 +1424,740 @@ class StorageServer():
                 self.xbmcvfs.delete(self.socket)
         self.xbmc.log("{0} Closed down".format(self.plugin))
 
-    def _recv(self, sock):
-        data = b"   "
-        idle = True
+    def _maintenance(self):
+        self.next_maintenance = time.time() + self.maintenance_interval
+        for key, spool in list(self.spools.items()):
+            if spool.used + self.spool_timeout < time.time():
+                self._closeSpool(key)
 
-        self._log(u"", 3)
-        i = 0
-        start = time.time()
-        while data[len(data) - 2:] != u"\r\n".encode('utf-8') or not idle:
-            self._log('Not idle')
+        if self.snapshot_dirty and time.time() >= self.next_snapshot:
             try:
-                if idle:
-                    recv_buffer = sock.recv(self.network_buffer_size)
-                    if isinstance(recv_buffer, str):
-                        recv_buffer = recv_buffer.encode('utf-8')
-                    idle = False
-                    i += 1
-                    self._log(u"got data  : {0} - {1} - {2}"
-                              u"+ {3} | {4}".format(
-                                  str(i), repr(idle), str(len(data)),
-                                  str(len(recv_buffer)),
-                                  repr(recv_buffer)[len(recv_buffer) - 5:]), 4)
-                    data += recv_buffer
-                    start = time.time()
-                elif not idle:
-                    if data[len(data) - 2:] == u"\r\n".encode('utf-8'):
-                        sock.send(u"COMPLETE\r\n{0}".format(
-                            " " * (15 - len(u"COMPLETE\r\n"))).encode('utf-8'))
-                        idle = True
-                        self._log(u"sent COMPLETE {0}".format(str(i)), 4)
-
-                    elif len(recv_buffer) > 0:
-                        sock.send(u"ACK\r\n{0}".format(
-                            (u" " * (15 - len(u"ACK\r\n")))).encode('utf-8'))
-                        idle = True
-                        self._log(u"sent ACK {0}".format(str(i)), 4)
-                    recv_buffer = ""
-                    self._log(u"status {0} - {1}".format(repr(not idle), repr(
-                        data[len(data) - 2:] != u"\r\n".encode('utf-8'))), 3)
+                self._buildSnapshot()
+            except Exception as e:
+                self._log("Exception: {0}".format(repr(e)))
+            self.snapshot_dirty = False
+            self.next_snapshot = time.time() + self.snapshot_interval
+
+        if self.sweeper is None:
+            if time.time() < self.next_sweep:
+                return
+            self._flushAccess()
+            self.sweeper = self._sweep()
+
+        try:
+            next(self.sweeper)
+        except StopIteration:
+            self.sweeper = None
+            self.next_sweep = time.time() + self.sweep_interval
+        except Exception as e:
+            self._log("Exception: {0}".format(repr(e)))
+            self.sweeper = None
+            self.next_sweep = time.time() + self.sweep_interval
+
+    def _snapshotPath(self):
+        return os.path.join(os.path.dirname(self.path), 'commoncache.snapshot')
+
+    def _publish(self, table, name, enabled):
+        # name "" publishes the whole table.
+        self._checkTable(table)
+        if enabled:
+            self._sqlExecute("INSERT OR IGNORE INTO cache_snapshots (tbl, "
+                             "name) VALUES ( %s , %s )", (table, name))
+            self.published.setdefault(table, set()).add(name)
+        else:
+            self._sqlExecute("DELETE FROM cache_snapshots WHERE tbl = %s AND "
+                             "name = %s", (table, name))
+            self.published.get(table, set()).discard(name)
+            if not self.published.get(table):
+                self.published.pop(table, None)
+        self._deferCommit()
+        self._touched(table)
+        self._invalidateSnapshot()
+        return "true"
 
+    def _touched(self, table):
+        # Every change to table: its reads stay on this thread until the
+        # commit, and the snapshot isn't trusted until it is rebuilt.
+        self.generations[table] = self.generations.get(table, 0) + 1
+        self.changed.add(table)
+        if table in self.published and self.snapshot_valid:
+            self._invalidateSnapshot()
+
+    def _invalidateSnapshot(self):
+        # Zeroed in place, valid reaches readers that have the file mapped.
+        self.snapshot_dirty = True
+        self.snapshot_valid = False
+        path = self._snapshotPath()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r+b") as snapshot:
+                snapshot.seek(_SNAPSHOT_VALID)
+                snapshot.write(struct.pack("!d", 0))
+        except (IOError, OSError) as e:
+            self._log("Exception: {0}".format(repr(e)), 2)
+
+    def _buildSnapshot(self):
+        # Written to a temporary file and moved over the old one, so readers
+        # never see half of it.
+        path = self._snapshotPath()
+        if not self.published:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        now = time.time()
+        entries = []
+        for table in sorted(self.published):
+            self._checkTable(table)
+            names = self.published[table]
+            sql = ("SELECT name, data, expires_at FROM {0} WHERE "
+                   "(expires_at IS NULL OR expires_at > ?)".format(table))
+            if "" in names:
+                self.curs.execute(sql, (now,))
+                rows = self.curs.fetchall()
+            else:
+                rows = []
+                names = sorted(names)
+                for start in range(0, len(names), _IN_BATCH):
+                    batch = names[start:start + _IN_BATCH]
+                    self.curs.execute(
+                        "{0} AND name IN ({1})".format(
+                            sql, ",".join("?" * len(batch))),
+                        [now] + batch)
+                    rows.extend(self.curs.fetchall())
+            for name, data, expires_at in rows:
+                if isinstance(data, text):
+                    entries.append((table, name, data.encode('utf-8'),
+                                    expires_at, 0))
+                elif isinstance(data, bytes):
+                    entries.append((table, name, data, expires_at, 1))
+
+        slots = 16
+        while slots < 2 * len(entries):
+            slots *= 2
+        index = [(0, 0)] * slots
+        body = bytearray()
+        start = _SNAPSHOT_HEADER.size + slots * _SNAPSHOT_SLOT.size
+        for table, name, data, expires_at, binary in entries:
+            key, keyhash = _snapshotKey(table, name)
+            slot = keyhash & (slots - 1)
+            while index[slot][1]:
+                slot = (slot + 1) & (slots - 1)
+            index[slot] = (keyhash, start + len(body))
+            body += _SNAPSHOT_ENTRY.pack(len(key), len(data),
+                                         expires_at or 0, binary)
+            body += key
+            body += data
+
+        temp = path + ".tmp"
+        with open(temp, "wb") as snapshot:
+            # Even unchanged, the snapshot is only trusted for a while in
+            # case the server stops without noticing a change.
+            snapshot.write(_SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC, now, now + 600, slots, len(entries)))
+            snapshot.write(b"".join(_SNAPSHOT_SLOT.pack(*slot)
+                                    for slot in index))
+            snapshot.write(body)
+        getattr(os, "replace", os.rename)(temp, path)
+        self.snapshot_valid = True
+        self._log(u"Snapshot of {0} entries".format(len(entries)), 2)
+
+    def _sweep(self):
+        # Removes expired rows and frees their pages in bounded batches, one
+        # per step that _maintenance() advances.
+        self._sqlExecute("DELETE FROM cache_locks WHERE expires_at <= %s",
+                         time.time())
+        self._commit()
+        yield
+
+        removed = 0
+        for table in self._listTables():
+            self._checkTable(table)
+            count = self.sweep_batch
+            while count == self.sweep_batch:
+                self._sqlExecute(
+                    "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} "
+                    "WHERE expires_at <= %s LIMIT %s)".format(table),
+                    (time.time(), self.sweep_batch))
+                count = max(self.curs.rowcount, 0)
+                self._commit()
+                removed += count
+                yield
+
+        # Entries of namespace generations before the current one.
+        for table, namespace in [key for key in self.namespaces
+                                 if self.namespaces[key][1] <
+                                 self.namespaces[key][0]]:
+            self._checkTable(table)
+            count = self.sweep_batch
+            while count == self.sweep_batch:
+                count = self._reclaim(table, namespace, self.sweep_batch)
+                self._commit()
+                self.counters["invalidated"] += count
+                yield
+
+        self.sizes.clear()
+        reclaimed = 0
+        free = self._pragma("freelist_count")
+        while free:
+            self.curs.execute("PRAGMA incremental_vacuum({0})".format(
+                self.sweep_batch))
+            self.curs.fetchall()
+            left = self._pragma("freelist_count")
+            if left >= free:
+                break
+            reclaimed += free - left
+            free = left
+            yield
+
+        self.counters["expired"] += removed
+        self.counters["reclaimed_bytes"] += (
+            reclaimed * self._pragma("page_size"))
+        self._log(u"Cleanup removed {0} expired entries, reclaimed {1} "
+                  u"pages".format(removed, reclaimed))
+
+    def _pragma(self, name):
+        self.curs.execute("PRAGMA {0}".format(name))
+        return self.curs.fetchone()[0]
+
+    def _listTables(self):
+        # Client tables are alphanumeric, internal ones are not.
+        self.curs.execute("SELECT name FROM sqlite_master WHERE type = ?",
+                          ("table",))
+        return [row[0] for row in self.curs.fetchall() if row[0].isalnum()]
+
+    def _acceptClients(self, sock, selector):
+        while True:
+            try:
+                (clientsocket, address) = sock.accept()
             except socket.error as e:
-                if e.errno not in [10035, 35]:
-                    self._log(u"Except error! {0}".format(repr(e)))
+                if e.errno not in [11, 35, 10035]:
+                    self._log("Exception: {0}".format(repr(e)))
+                return
 
-                if e.errno in [22]:  # We can't fix this.
-                    return ""
+            clientsocket.setblocking(0)
+            client = _ClientConnection(self, clientsocket)
+            self.clients.add(client)
+            selector.register(clientsocket, EVENT_READ, client)
+            self._log("accepted, {0} clients".format(len(self.clients)), 3)
 
-                if start + 10 < time.time():
-                    self._log(u"over time", 2)
-                    break
+    def _serviceClient(self, selector, client, mask):
+        try:
+            alive = True
+            if mask & EVENT_READ:
+                alive = client.readable()
+            if alive and (mask & EVENT_WRITE or client.outbuf):
+                alive = client.writable()
+        except socket.error as e:
+            if e.errno in [11, 35, 10035]:
+                alive = True
+            else:
+                self._log("Exception: {0}".format(repr(e)), 2)
+                alive = False
+        except Exception as e:
+            self._log("Exception: {0}".format(repr(e)))
+            alive = False
+
+        if not alive:
+            self._closeClient(selector, client)
+        elif client.outbuf:
+            selector.modify(client.sock, EVENT_READ | EVENT_WRITE, client)
+        else:
+            selector.modify(client.sock, EVENT_READ, client)
+
+    def _deferCommit(self):
+        # Group commit: writes stay in the transaction until no requests are
+        # waiting or commit_window has passed.
+        self.writes += 1
+        if self.uncommitted is None:
+            self.uncommitted = time.time()
+
+    def _commit(self):
+        self.conn.commit()
+        self.uncommitted = None
+        self.changed.clear()
+        held, self.held = self.held, set()
+        for client in held:
+            client.release()
+            if client in self.clients:
+                self._serviceClient(self.selector, client, EVENT_WRITE)
+
+    def _closeClient(self, selector, client):
+        self.held.discard(client)
+        for key in list(self.waiters):
+            self.waiters[key] = [waiter for waiter in self.waiters[key]
+                                 if waiter[1] is not client]
+            if not self.waiters[key]:
+                del self.waiters[key]
+        for flight in self.flights.values():
+            flight[1] = [waiter for waiter in flight[1]
+                         if waiter[1] is not client]
+        self.clients.discard(client)
+        try:
+            selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        self._log("closed, {0} clients".format(len(self.clients)), 3)
 
-        self._log(u"done", 3)
-        return data.strip()
+    def _recv(self, sock):
+        self._log(u"", 3)
+        try:
+            header = self._recvExactly(sock, _FRAME.size)
+            magic, version, flags, length = _FRAME.unpack(bytes(header))
+            if magic != _MAGIC or version != PROTOCOL_VERSION:
+                self._log(u"Bad frame header: {0}".format(repr(header)))
+                return b""
+            data = self._recvExactly(sock, length)
+        except socket.error as e:
+            self._log(u"Except error {0}".format(repr(e)))
+            return b""
+
+        self._log(u"done: {0}".format(str(len(data))), 3)
+        return bytes(data)
+
+    def _recvExactly(self, sock, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        got = 0
+        while got < size:
+            received = sock.recv_into(view[got:], size - got)
+            if not received:
+                raise socket.error(32, "Connection closed by server")
+            got += received
+        return data
 
     def _send(self, sock, data):
-        idle = True
-        status = ""
         self._log(u"{0} - {1}".format(str(len(data)), repr(data)[0:20]), 3)
-        i = 0
-        start = time.time()
-        while len(data) > 0 or not idle:
-            send_buffer = b" "
-            try:
-                if idle:
-                    if len(data) > self.network_buffer_size:
-                        send_buffer = data[:self.network_buffer_size]
-                    else:
-                        send_buffer = data + "\r\n"
-                    if isinstance(send_buffer, str):
-                        send_buffer = send_buffer.encode('utf-8')
-                    result = sock.send(send_buffer)
-                    i += 1
-                    idle = False
-                    start = time.time()
-                elif not idle:
-                    status = b""
-                    while status.find(u"COMPLETE\r\n".encode(
-                            'utf-8')) == -1 and status.find(
-                            u"ACK\r\n".encode('utf-8')) == -1:
-                        status = sock.recv(15)
-                        i -= 1
-
-                    idle = True
-                    if len(data) > self.network_buffer_size:
-                        data = data[self.network_buffer_size:]
-                    else:
-                        data = ""
-
-                    self._log(u"Got response {0} - {1} == {2} "
-                              u"| {3} - {4}".format(
-                                  str(i), str(result),
-                                  str(len(send_buffer)),
-                                  str(len(data)),
-                                  repr(send_buffer)[
-                                      len(send_buffer) - 5:]), 3)
+        try:
+            sock.sendall(_frame(data))
+        except socket.error as e:
+            self._log(u"Except error {0}".format(repr(e)))
+            return False
 
-            except socket.error as e:
-                self._log(u"Except error {0}".format(repr(e)))
-                if all([e.errno != 10035, e.errno != 35, e.errno != 107,
-                       e.errno != 32]):
-                    self._log(u"Except error {0}".format(repr(e)))
-                    if start + 10 < time.time():
-                        self._log(u"Over time", 2)
-                        break
         self._log(u"Done", 3)
-        return status.find(u"COMPLETE\r\n".encode('utf-8')) > -1
+        return True
 
-    def _lock(self, table, name):  # This is NOT atomic
+    def _lock(self, table, name, owner=None, lease=None, timeout=None):
+        # Taken if free or its lease ran out. With a timeout a protocol 2
+        # client is answered once the lock is handed to it, or with "false".
         self._log(name, 1)
-        locked = True
-        curlock = self._sqlGet(table, name)
-        if curlock.strip():
-            if float(curlock) < self.daemon_start_time:
-                self._log(u"removing stale lock.")
-                self._sqlExecute(
-                    "DELETE FROM {0} WHERE name = %s".format(table), (name,))
-                self.conn.commit()
-                locked = False
-        else:
-            locked = False
-
-        if not locked:
-            self._sqlExecute(
-                "INSERT INTO {0} VALUES ( %s , %s )".format(table),
-                (name, time.time()))
-            self.conn.commit()
-            self._log(u"locked: {0}".format(name.decode('utf8', 'ignore')))
-
-            return "true"
-
-        self._log(u"failed for : {0}".format(name.decode('utf8', 'ignore')), 1)
+        owner = owner or ""
+        if not self.waiters.get((table, name)):
+            if self._acquire(table, name, owner, lease):
+                self._log(u"locked: {0}".format(name), 1)
+                return "true"
+
+        if timeout and self.requester is not None:
+            self._log(u"waiting for : {0}".format(name), 1)
+            self.waiters.setdefault((table, name), []).append(
+                (time.time() + float(timeout), self.requester, owner, lease))
+            self._scheduleWake()
+            return _DEFERRED
+
+        self._log(u"failed for : {0}".format(name), 1)
         return "false"
 
-    def _unlock(self, table, name):
+    def _acquire(self, table, name, owner, lease):
+        # The primary key makes the insert a compare-and-set, a no-op with
+        # nothing to commit while another owner holds the lock.
+        now = time.time()
+        self._sqlExecute("DELETE FROM cache_locks WHERE tbl = %s AND "
+                         "name = %s AND expires_at <= %s", (table, name, now))
+        changed = self.curs.rowcount > 0
+        self._sqlExecute("INSERT OR IGNORE INTO cache_locks (tbl, name, "
+                         "owner, expires_at) VALUES ( %s , %s , %s , %s )",
+                         (table, name, owner,
+                          now + float(lease or self.lock_lease)))
+        acquired = self.curs.rowcount == 1
+        if changed or acquired:
+            self._deferCommit()
+        return acquired
+
+    def _unlock(self, table, name, owner=None):
+        # Without an owner (old clients) any holder's lock is released.
         self._log(name, 1)
 
-        self._checkTable(table)
-        self._sqlExecute("DELETE FROM {0} WHERE name = %s".format(table),
-                         (name,))
+        if owner is None:
+            self._sqlExecute("DELETE FROM cache_locks WHERE tbl = %s AND "
+                             "name = %s", (table, name))
+        else:
+            self._sqlExecute("DELETE FROM cache_locks WHERE tbl = %s AND "
+                             "name = %s AND owner = %s", (table, name, owner))
+        released = owner is None or self.curs.rowcount == 1
+        self._deferCommit()
 
-        self.conn.commit()
+        if (table, name) in self.waiters:
+            self._wakeWaiters()
         self._log(u"done", 1)
-        return "true"
+        return "true" if released else "false"
+
+    def _wakeWaiters(self):
+        # Hand free locks to their first waiter, turn away timed out ones.
+        now = time.time()
+        for (table, name), waiters in list(self.waiters.items()):
+            while waiters:
+                deadline, client, owner, lease = waiters[0]
+                if self._acquire(table, name, owner, lease):
+                    result = "true"
+                elif deadline <= now:
+                    result = "false"
+                else:
+                    break
+                waiters.pop(0)
+                self._log(u"{0} waiter for : {1}".format(result, name), 1)
+                self._reply(client, result)
+            if not waiters:
+                del self.waiters[(table, name)]
+
+        for key, flight in list(self.flights.items()):
+            if flight[0] <= now:
+                self._land(key, "")
+                continue
+            for waiter in [waiter for waiter in flight[1]
+                           if waiter[0] <= now]:
+                flight[1].remove(waiter)
+                self._reply(waiter[1], "")
+        self._scheduleWake()
+
+    def _scheduleWake(self):
+        # Wake up for the first lease, flight or waiter timeout to run out.
+        wake = []
+        for (table, name), waiters in self.waiters.items():
+            wake.extend(waiter[0] for waiter in waiters)
+            self.curs.execute("SELECT expires_at FROM cache_locks WHERE "
+                              "tbl = ? AND name = ?", (table, name))
+            wake.extend(row[0] for row in self.curs.fetchall())
+        for expires_at, waiters in self.flights.values():
+            wake.append(expires_at)
+            wake.extend(waiter[0] for waiter in waiters)
+        self.next_wake = min(wake) if wake else None
+
+    def _reply(self, client, res, wrote=True):
+        client.reply(res, wrote)
+        if client in self.clients and client.outbuf:
+            self._serviceClient(self.selector, client, EVENT_WRITE)
+
+    def _flight(self, table, name, timeout, wait=True):
+        # Single flight for a miss: the first client gets True and computes,
+        # the others wait for what it stores, or get "" when it gives up or
+        # timeout passes.
+        self._log(name, 2)
+        now = time.time()
+        flight = self.flights.get((table, name))
+        if flight and flight[0] <= now:
+            self._land((table, name), "")
+            flight = None
+
+        if flight is None:
+            self.flights[(table, name)] = [now + float(timeout), []]
+            self._scheduleWake()
+            return True
+
+        if self.requester is None or not wait:
+            return ""
+        flight[1].append((now + float(timeout), self.requester))
+        self._scheduleWake()
+        return _DEFERRED
+
+    def _land(self, key, data):
+        # End the flight on key, handing data to everyone waiting for it.
+        flight = self.flights.pop(key, None)
+        if flight:
+            self._log(u"{0} waiters for : {1}".format(len(flight[1]), key[1]),
+                      2)
+            for deadline, client in flight[1]:
+                self._reply(client, data)
+            self._scheduleWake()
+        return ""
 
-    def _sqlSetMulti(self, table, pre, inp_data):
+    def _sqlSetMulti(self, table, pre, inp_data, ttl=None):
         self._log(pre, 1)
         self._checkTable(table)
-        for name in inp_data:
-            if self._sqlGet(table, "{0}{1}".format(pre, name)).strip():
-                self._log(
-                    u"Update (0): ".format(pre, name.decode('utf8', 'ignore')),
-                    3)
-                self._sqlExecute(
-                    "UPDATE {0} SET data = %s WHERE name = %s".format(table),
-                    (inp_data[name], "{0}{1}".format(pre, name)))
-            else:
-                self._log(
-                    u"Insert : {0}".format(pre, name.decode('utf8', 'ignore')),
-                    3)
-                self._sqlExecute(
-                    "INSERT INTO {0} VALUES ( %s , %s )".format(table),
-                    ("{0}{1}".format(pre, name), inp_data[name]))
+        self._sqlWrite(table, [("{0}{1}".format(pre, name), inp_data[name])
+                               for name in inp_data], ttl)
 
-        self.conn.commit()
+        self._enforceQuota(table)
+        self._deferCommit()
+        for name in inp_data:
+            self._land(_flightKey(table, "{0}{1}".format(pre, name)),
+                       inp_data[name])
         self._log(u"Done", 3)
         return ""
 
     def _sqlGetMulti(self, table, pre, items):
+        return self._sqlGetMap(table, pre, items, ordered=True)
+
+    def _sqlGetMap(self, table, pre, items, ordered=False):
         self._log(pre, 1)
 
         self._checkTable(table)
-        ret_val = []
-        for name in items:
-            self._log('{0}{1}'.format(pre, name), 3)
-            self._sqlExecute(
-                "SELECT data FROM {0} WHERE name = %s".format(table),
-                ("{0}{1}".format(pre, name)))
+        now = time.time()
+        keys = dict((u"{0}{1}".format(pre, name), u"{0}".format(name))
+                    for name in items)
+        found = {}
+        missing = []
+        for key in keys:
+            data = self.hot.get((table, key))
+            if data is None:
+                missing.append(key)
+            else:
+                found[keys[key]] = data
+                self.accessed[(table, key)] = now
+        self.counters["hot_hits"] += len(found)
+        self.counters["hot_misses"] += len(missing)
+
+        def finish(rows, now, fresh):
+            for key, data, expires_at in rows:
+                found[keys[key]] = data
+                self.accessed[(table, key)] = now
+                if fresh:
+                    self.hot.set((table, key), data,
+                                 _remaining(expires_at, now))
+
+            self._log(u"Found {0} of {1}".format(len(found), len(keys)), 2)
+            if ordered:
+                return [found.get(u"{0}".format(name), "") for name in items]
+            return found
+
+        if len(missing) < _READER_MIN:
+            return finish(_queryMap(self.curs, table, now, missing), now,
+                          True)
+        return self._read(_queryMap, table, (missing,), finish)
+
+    def _sqlSet(self, table, name, data, ttl=None):
+        self._log('{0}{1}'.format(name, str(repr(data))[0:20]), 2)
 
-            result = ""
-            for row in self.curs:
-                self._log(u"Adding : {0}".format(str(repr(row[0]))[0:20]), 3)
-                result = row[0]
-            ret_val += [result]
+        self._checkTable(table)
+        self._sqlWrite(table, [(name, data)], ttl)
 
-        self._log(u"Returning : {0}".format(repr(ret_val)), 2)
-        return ret_val
+        self._enforceQuota(table)
+        self._deferCommit()
+        self._land(_flightKey(table, name), data)
+        self._log(u"Done", 2)
+        return ""
 
-    def _sqlSet(self, table, name, data):
-        self._log('{0}{1}'.format(name, str(repr(data))[0:20]), 2)
+    def _sqlWrite(self, table, items, ttl):
+        now = time.time()
+        expires = now + float(ttl) if ttl else None
+        rows = []
+        for name, data in items:
+            self._log(u"Write : {0}".format(name), 3)
+            rows.append((name, data, expires, now, now, _dataSize(data)))
+
+        written = self._sqlExecute(self.upsert.format(table), rows,
+                                   many=True)
+        for name, data in items:
+            # Other values are read back as SQLite converted them, if at all.
+            if written and isinstance(data, (text, bytes)):
+                self.hot.set((table, name), data, ttl and float(ttl))
+            else:
+                self.hot.discard((table, name))
+        self._touched(table)
+        # Overwritten rows are counted twice until the next recount, which
+        # only makes the quota check recount a little early.
+        if table in self.sizes:
+            self.sizes[table] += sum(row[5] for row in rows)
+
+    def _readStream(self, table, name, offset, size):
+        # Up to size bytes from offset, b"" past the end, None without a value.
+        self._log(u"{0} {1}".format(name, offset), 2)
+        self._checkTable(table)
 
+        now = time.time()
+        self._sqlExecute("SELECT rowid FROM {0} WHERE name = %s AND "
+                         "(expires_at IS NULL OR expires_at > %s)".format(
+                             table), (name, now))
+        row = self.curs.fetchone()
+        if row is None:
+            return None
+        self.accessed[(table, name)] = now
+
+        if self.blob_io:
+            blob = self.conn.blobopen(table, "data", row[0], readonly=True)
+            try:
+                if offset >= len(blob):
+                    return b""
+                blob.seek(offset)
+                return blob.read(size)
+            finally:
+                blob.close()
+
+        # SQLite copies the whole value for every substr() of it, so copy
+        # it once and read the chunks from a spool.
+        key = ("read", table, name)
+        generation = self.generations.get(table, 0)
+        spool = self.spools.get(key)
+        if not offset or spool is None or spool.generation != generation:
+            self._closeSpool(key)
+            self._sqlExecute("SELECT data FROM {0} WHERE rowid = %s".format(
+                table), row[0])
+            data = self.curs.fetchone()[0]
+            if isinstance(data, text):
+                data = data.encode('utf-8')
+            spool = self.spools[key] = _Spool(os.path.dirname(self.path),
+                                              generation)
+            spool.file.write(data or b"")
+            del data
+
+        spool.used = now
+        spool.file.seek(offset)
+        chunk = spool.file.read(size)
+        if len(chunk) < size:
+            self._closeSpool(key)
+        return chunk
+
+    def _closeSpool(self, key):
+        spool = self.spools.pop(key, None)
+        if spool is not None:
+            spool.close()
+
+    def _writeStream(self, table, name, data, offset, size, ttl=None,
+                     final=False):
+        # The first chunk creates a staging row at the full size, every
+        # chunk is written in place, with BLOB I/O or into a spool stored at
+        # the end, and the complete value replaces the one under name. An
+        # abandoned stream's staging row expires after spool_timeout.
+        self._log(u"{0} {1}".format(name, offset), 2)
         self._checkTable(table)
-        if self._sqlGet(table, name).strip():
-            self._log(u"Update : {0}".format(data), 3)
-            self._sqlExecute(
-                "UPDATE {0} SET data = %s WHERE name = %s".format(table),
-                (data, name))
+
+        if size is None:
+            raise ValueError("Stream size is required")
+        if offset + len(data) > size:
+            raise ValueError("Stream longer than its size")
+
+        key = ("write", table, name)
+        staging = name + _STREAM_STAGING
+        if final and offset + len(data) < size:
+            self._log(u"Stream of {0} ended short at {1}".format(
+                name, offset + len(data)))
+            self._closeSpool(key)
+            self._sqlExecute("DELETE FROM {0} WHERE name = %s".format(table),
+                             staging)
+            self._deferCommit()
+            return "false"
+
+        if not offset:
+            self._sqlWrite(table, [(staging, b"")], self.spool_timeout)
+            self._sqlExecute("UPDATE {0} SET data = zeroblob(%s), "
+                             "size = %s WHERE name = %s".format(table),
+                             (size, size, staging))
+            self.hot.discard((table, staging))
+            if table in self.sizes:
+                self.sizes[table] += size
+            if not self.blob_io:
+                self._closeSpool(key)
+                self.spools[key] = _Spool(os.path.dirname(self.path))
         else:
-            self._log(u"Insert : {0}".format(data), 3)
-            self._sqlExecute(
-                "INSERT INTO {0} VALUES ( %s , %s )".format(table),
-                (name, data))
+            now = time.time()
+            self._sqlExecute("UPDATE {0} SET expires_at = %s WHERE name = %s "
+                             "AND expires_at > %s".format(table),
+                             (now + self.spool_timeout, staging, now))
+            if self.curs.rowcount < 1:
+                self._closeSpool(key)
+                raise ValueError("Stream not started")
+
+        if self.blob_io:
+            self._sqlExecute("SELECT rowid FROM {0} WHERE name = %s".format(
+                table), staging)
+            blob = self.conn.blobopen(table, "data", self.curs.fetchone()[0])
+            try:
+                blob.seek(offset)
+                blob.write(data)
+            finally:
+                blob.close()
+        else:
+            spool = self.spools.get(key)
+            if spool is None:
+                raise ValueError("Stream not started")
+            spool.used = time.time()
+            spool.file.seek(offset)
+            spool.file.write(data)
+
+        if offset + len(data) == size:
+            if not self.blob_io:
+                spool.file.seek(0)
+                self._sqlExecute("UPDATE {0} SET data = %s "
+                                 "WHERE name = %s".format(table),
+                                 (sqlite3.Binary(spool.file.read()), staging))
+                self._closeSpool(key)
+            self._sqlExecute("DELETE FROM {0} WHERE name = %s".format(table),
+                             name)
+            self._sqlExecute("UPDATE {0} SET name = %s, expires_at = %s "
+                             "WHERE name = %s".format(table),
+                             (name, time.time() + float(ttl) if ttl else None,
+                              staging))
+            self.hot.discard((table, name))
+            self._touched(table)
+
+        self._enforceQuota(table)
+        self._deferCommit()
+        return "true"
 
-        self.conn.commit()
-        self._log(u"Done", 2)
-        return ""
+    def _tableSize(self, table):
+        if table not in self.sizes:
+            self._checkTable(table)
+            self.curs.execute(
+                "SELECT total(size) FROM {0}".format(table))
+            self.sizes[table] = int(self.curs.fetchone()[0])
+        return self.sizes[table]
+
+    def _enforceQuota(self, table):
+        # Evict least recently used rows down to 90% of the table's or the
+        # database's budget.
+        budget = self.quotas.get(table) or self.db_quota
+        if self.db_quota:
+            budget = min(budget, self.db_quota)
+        if budget and self._tableSize(table) > budget:
+            self.sizes.pop(table)
+            if self._tableSize(table) > budget:
+                self._evict(table, self.sizes[table] - int(budget * 0.9))
+
+        if self.db_quota:
+            sizes = dict((name, self._tableSize(name))
+                         for name in self._listTables())
+            if sum(sizes.values()) > self.db_quota:
+                # The biggest table is the one crowding out the others.
+                self._evict(max(sizes, key=sizes.get),
+                            sum(sizes.values()) - int(self.db_quota * 0.9))
+
+    def _evict(self, table, excess):
+        self._flushAccess()
+        evicted = 0
+        while excess > 0:
+            self.curs.execute(
+                "SELECT rowid, size, name FROM {0} ORDER BY accessed_at "
+                "LIMIT ?".format(table), (self.sweep_batch,))
+            victims = []
+            for rowid, size, name in self.curs.fetchall():
+                victims.append((rowid,))
+                self.hot.discard((table, name))
+                excess -= size or 0
+                if excess <= 0:
+                    break
+            if not victims:
+                break
+            self.curs.executemany(
+                "DELETE FROM {0} WHERE rowid = ?".format(table), victims)
+            evicted += len(victims)
+            self._touched(table)
+
+        self.sizes.pop(table, None)
+        self.counters["evicted"] += evicted
+        self._log(u"Evicted {0} rows from {1}".format(evicted, table), 1)
+
+    def _flushAccess(self):
+        # The access times collected by reads, in one batch.
+        if not self.accessed:
+            return
+        accessed, self.accessed = self.accessed, {}
+        for table in set(table for table, name in accessed):
+            self.curs.executemany(
+                "UPDATE {0} SET accessed_at = ? WHERE name = ?".format(table),
+                [(when, name) for (row_table, name), when in accessed.items()
+                 if row_table == table])
+        self._commit()
 
     def _sqlDel(self, table, name):
         self._log('{0} - {1}'.format(name, table), 1)
@@ -501,28 +2166,167 @@ class StorageServer():
 
         self._sqlExecute("DELETE FROM {0} WHERE name LIKE %s".format(table),
                          name)
-        self.conn.commit()
+        self._touched(table)
+        self._deferCommit()
+        self.sizes.pop(table, None)
+        self.hot.invalidate(table)
+        self._log(u"done", 1)
+        return "true"
+
+    def _sqlDelPrefix(self, table, prefix):
+        # Unlike LIKE, a range of names uses the index on name.
+        self._log(u"{0} - {1}".format(prefix, table), 1)
+
+        self._checkTable(table)
+        self._deleteRange(table, prefix, _prefixEnd(prefix))
+        self._touched(table)
+        self._deferCommit()
+        self.hot.invalidate(table)
         self._log(u"done", 1)
         return "true"
 
-    def _sqlGet(self, table, name):
+    def _deleteRange(self, table, low, high, limit=None):
+        where, args = "name >= %s", (low, )
+        if high is not None:
+            where, args = "name >= %s AND name < %s", (low, high)
+        if limit is None:
+            self._sqlExecute("DELETE FROM {0} WHERE {1}".format(table, where),
+                             args)
+        else:
+            self._sqlExecute(
+                "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} "
+                "WHERE {1} LIMIT %s)".format(table, where), args + (limit, ))
+        self.sizes.pop(table, None)
+        return max(self.curs.rowcount, 0)
+
+    def _namespaced(self, table, namespace, name):
+        generation = self.namespaces.get((table, namespace), (0, 0))[0]
+        return u"{0}{1}{2:08x}{1}{3}".format(
+            namespace, _NAMESPACE_SEPARATOR, generation, name)
+
+    def _invalidate(self, table, namespace, eager=False):
+        # Moves namespace to its next generation, whose names are all new. The
+        # old entries go with the next sweep, or now when eager.
+        self._log(u"{0} - {1}".format(namespace, table), 1)
+        self._checkTable(table)
+        key = (table, namespace)
+        generation, reclaimed = self.namespaces.get(key, (0, 0))
+        self.namespaces[key] = [generation + 1, reclaimed]
+        self._saveNamespace(key)
+        if eager:
+            self.counters["invalidated"] += self._reclaim(table, namespace)
+            self.hot.invalidate(table)
+        self._touched(table)
+        self._deferCommit()
+        return "true"
+
+    def _reclaim(self, table, namespace, limit=None):
+        # Remove up to limit entries of older generations of namespace.
+        key = (table, namespace)
+        generation = self.namespaces[key][0]
+        prefix = namespace + _NAMESPACE_SEPARATOR
+        removed = self._deleteRange(
+            table, prefix, u"{0}{1:08x}".format(prefix, generation), limit)
+        if limit is None or removed < limit:
+            self.namespaces[key][1] = generation
+            self._saveNamespace(key)
+        return removed
+
+    def _saveNamespace(self, key):
+        generation, reclaimed = self.namespaces[key]
+        self._sqlExecute("INSERT OR REPLACE INTO cache_namespaces (tbl, "
+                         "namespace, generation, reclaimed) VALUES ( %s , %s "
+                         ", %s , %s )", key + (generation, reclaimed))
+
+    def _sqlClean(self, table, empty):
+        self._log(u"{0} - {1}".format(table, repr(empty)), 1)
+
+        self._checkTable(table)
+        if empty:
+            # cacheFunction names, LIKE would ignore case and take set()
+            # names such as "CacheVersion" along.
+            self._sqlExecute(
+                "DELETE FROM {0} WHERE name GLOB %s".format(table),
+                "cache*|*|")
+        else:
+            self._sqlExecute(
+                "DELETE FROM {0} WHERE expires_at <= %s".format(table),
+                time.time())
+        removed = max(self.curs.rowcount, 0)
+        self._touched(table)
+        self._deferCommit()
+        self.sizes.pop(table, None)
+        self.hot.invalidate(table)
+        self.counters["expired"] += removed
+        self._log(u"removed {0}".format(removed), 1)
+        return text(removed)
+
+    def _sqlGet(self, table, name, remaining=False):
+        # The value of name, with remaining the value and the seconds it
+        # has left, None for ever.
         self._log("{0} - {1}".format(name, table), 2)
 
+        now = time.time()
+        item = self.hot.lookup((table, name))
+        if item is not None:
+            self.counters["hot_hits"] += 1
+            self.accessed[(table, name)] = now
+            return list(item) if remaining else item[0]
+
+        self.counters["hot_misses"] += 1
         self._checkTable(table)
-        self._sqlExecute("SELECT data FROM {0} WHERE name = %s".format(table),
-                         name)
 
-        for row in self.curs:
-            self._log(u"Returning :  {0}".format(str(repr(row[0]))[0:20]), 3)
-            return row[0]
+        def finish(rows, now, fresh):
+            for row in rows:
+                self._log(u"Returning :  {0}".format(
+                    str(repr(row[0]))[0:20]), 3)
+                self.accessed[(table, name)] = now
+                if fresh:
+                    self.hot.set((table, name), row[0],
+                                 _remaining(row[1], now))
+                if remaining:
+                    return [row[0], _remaining(row[1], now)]
+                return row[0]
+
+            self._log(u"Returning empty", 3)
+            return [" ", None] if remaining else " "
+
+        # A lookup by name is quicker here than handed to a reader.
+        now = time.time()
+        return finish(_queryGet(self.curs, table, now, name), now, True)
+
+    def _read(self, query, table, args, finish):
+        # finish(query(curs, table, now, *args), now, fresh) on a reader thread
+        # when the client can wait and table has nothing uncommitted, here
+        # otherwise. Only fresh rows may go into the hot cache.
+        now = time.time()
+        if (self.readers is None or self.requester is None or
+                table in self.changed):
+            return finish(query(self.curs, table, now, *args), now, True)
+
+        requester = self.requester
+        generation = self.generations.get(table, 0)
+
+        def done(rows):
+            if isinstance(rows, Exception):
+                self._log(u"Exception: {0}".format(repr(rows)))
+                res = ""
+            else:
+                res = finish(rows, now,
+                             self.generations.get(table, 0) == generation)
+            self._reply(requester, res, False)
 
-        self._log(u"Returning empty", 3)
-        return " "
+        self.readers.submit(query, (table, now) + args, done)
+        return _DEFERRED
 
-    def _sqlExecute(self, sql, data):
+    def _sqlExecute(self, sql, data, many=False):
         try:
             self._log("{0} - {1}".format(repr(sql), repr(data)), 5)
-            if self.sql2:
+            if many:
+                if self.sql3:
+                    sql = sql.replace("%s", "?")
+                self.curs.executemany(sql, data)
+            elif self.sql2:
                 self.curs.execute(sql, data)
             elif self.sql3:
                 sql = sql.replace("%s", "?")
@@ -530,6 +2334,7 @@ class StorageServer():
                     self.curs.execute(sql, data)
                 else:
                     self.curs.execute(sql, (data,))
+            return True
         except sqlite3.DatabaseError as e:
             if (self.xbmcvfs.exists(self.path) and (
                     str(e).find("file is encrypted") > -1 or str(e).find(
@@ -543,49 +2348,66 @@ class StorageServer():
                         repr(e)))
         except:
             self._log(u"Uncaught exception")
+        return False
 
     def _checkTable(self, table):
+        if table in self.tables:
+            return
+
         try:
             self.curs.execute(
-                "create table {0} (name text unique, data text)".format(table))
-            self.conn.commit()
-            self._log(u"Created new table")
-        except:
-            self._log(u"Passed", 5)
-            pass
+                "CREATE TABLE IF NOT EXISTS {0} "
+                "(name text unique, data text)".format(table))
+            self._migrateTable(table)
+            self._commit()
+            self.tables.add(table)
+        except Exception as e:
+            self._log(u"Exception: {0}".format(repr(e)))
+
+    def _migrateTable(self, table):
+        self.curs.execute(
+            "SELECT version FROM cache_schema WHERE name = ?", (table,))
+        row = self.curs.fetchone()
+        version = row[0] if row else 1
+        if version >= SCHEMA_VERSION:
+            return
+
+        self.curs.execute("PRAGMA table_info({0})".format(table))
+        columns = set(row[1] for row in self.curs.fetchall())
+        for migration_version, migration in _MIGRATIONS:
+            if migration_version <= version:
+                continue
+            self._log(u"Migrating {0} to schema {1}".format(
+                table, migration_version))
+            for statement in migration:
+                # ALTER TABLE runs outside the transaction, so an interrupted
+                # migration may already have added some of the columns.
+                if (statement.startswith("ALTER TABLE") and
+                        statement.split()[5] in columns):
+                    continue
+                self.curs.execute(statement.format(table))
+
+        self.curs.execute(
+            "INSERT OR REPLACE INTO cache_schema (name, version) "
+            "VALUES (?, ?)", (table, SCHEMA_VERSION))
 
     def _evaluate(self, data):
         try:
-            data = eval(data)  # Test json.loads vs eval
-            return data
+            return storageservercodec.decode(data)
         except:
             self._log(u"Couldn't evaluate message : {0}".format(repr(data)))
             return ""
 
-    def _generateKey(self, funct, *args):
+    def _generateKey(self, funct, *args, **kwargs):
         self._log(u"", 5)
-        name = repr(funct)
-        if name.find(" of ") > -1:
-            name = name[name.find("method") + 7:name.find(" of ")]
-        elif name.find(" at ") > -1:
-            name = name[name.find("function") + 9:name.find(" at ")]
-
-        keyhash = hashlib.md5()
-        for params in args:
-            if isinstance(params, dict):
-                for key in sorted(params.keys()):
-                    if key not in ["new_results_function"]:
-                        keyhash.update("'{0}'='{1}'".format(key, params[key]))
-            elif isinstance(params, list):
-                keyhash.update(",".join(["{0}".format(el for el in params)]))
-            else:
-                try:
-                    keyhash.update(params)
-                except:
-                    keyhash.update(params.encode('utf-8'))
-
-        name += "|{0}|".format(keyhash.hexdigest())
-
+        out = []
+        _encodeKey(args, out)
+        if kwargs:
+            _encodeItems(kwargs.items(), out)
+        keyhash = _newKeyHash()
+        keyhash.update(b"".join(out))
+
+        name = u"{0}|{1}|".format(_qualifiedName(funct), keyhash.hexdigest())
         self._log(u"Done: {0}".format(repr(name)), 5)
         return name
 
@@ -606,144 +2428,301 @@ class StorageServer():
                 del(cache[name])
 
         self._log(u"Done")
-        return False
+        return _MISSING
+
+    def _awaitFlight(self, name):
+        # The result of another client computing name, or _MISSING.
+        res = self._request(self._flightRequest(name), self.flight_timeout)
+        return self._flightResult(name, res)
+
+    def _flightRequest(self, name, wait=True):
+        return {"action": "flight", "table": self.table,
+                "name": "cache{0}".format(name),
+                "timeout": self.flight_timeout, "wait": wait}
+
+    def _flightResult(self, name, res):
+        # The result another client stored, or _MISSING when there is none
+        # and this one computes it.
+        if res is True or not res:
+            return _MISSING
+
+        self._log(u"Got result of another client: {0}".format(text(name)))
+        return self._getCache(name, self._evaluate(self._inflate(res)))
+
+    def _getStale(self, name, cache):
+        # An expired result that is still inside the stale window.
+        if not self.stale or name not in cache or "failures" in cache[name]:
+            return _MISSING
+
+        timeout = cache[name].get("timeout", 3600)
+        age = time.time() - cache[name]["timestamp"]
+        if timeout <= age < timeout + self.stale:
+            self._log(u"Done, found stale cache : {0}".format(text(name)))
+            return cache[name]["res"]
+        return _MISSING
+
+    def _refresh(self, funct, name, args, kwargs, timeout=None):
+        # Background half of stale-while-revalidate. Clients in other
+        # processes may be refreshing the same entry, the flight tells.
+        if self.flight_timeout:
+            res = self._request(self._flightRequest(name, wait=False))
+            if res is not None and res is not True:
+                self._log(u"Already refreshing: {0}".format(text(name)), 1)
+                return
+
+        self._log(u"Refreshing: {0}".format(text(name)))
+        try:
+            ret_val = funct(*args, **kwargs)
+        except Exception as e:
+            self._log(u"Refresh failed: {0}".format(repr(e)))
+            self._endFlight(name)
+            return
+        if not self._setCache({}, name, ret_val, timeout):
+            self._endFlight(name)
+
+    def _endFlight(self, name):
+        # Nothing gets stored, let the waiting clients compute themselves.
+        if self.flight_timeout:
+            self._request(self._landRequest(name))
+
+    def _landRequest(self, name):
+        return {"action": "land", "table": self.table,
+                "name": "cache{0}".format(name)}
+
+    def _setCache(self, cache, name, ret_val, timeout=None, failures=0):
+        # Store ret_val, see _cacheEntry. Returns whether it was.
+        entry = self._cacheEntry(cache, name, ret_val, timeout, failures)
+        if entry is None:
+            return False
+        self.set("cache{0}".format(name), *entry)
+        return True
 
-    def _setCache(self, cache, name, ret_val):
+    def _cacheEntry(self, cache, name, ret_val, timeout=None, failures=0):
+        # The value and ttl storing ret_val, None when it isn't stored. Empty
+        # results keep for negative_timeout, failures back off.
         self._log(u"")
-        if len(ret_val) > 0:
-            if not isinstance(cache, dict):
-                cache = {}
-            cache[name] = {"timestamp": time.time(),
-                           "timeout": self.timeout,
-                           "res": ret_val}
-            self._log(u"Saving cache: {0}{1}".format(name, str(
-                repr(cache[name]["res"]))[0:50]), 1)
-            self.set("cache{0}".format(name), repr(cache))
-        self._log(u"Done")
-        return ret_val
+        if timeout is None:
+            timeout = self.timeout
+        if failures:
+            timeout = min(self.negative_timeout * 2 ** (failures - 1),
+                          self.error_backoff)
+        elif not ret_val:
+            timeout = self.negative_timeout
+        if not timeout:
+            self._log(u"Done, not stored")
+            return None
+
+        if not isinstance(cache, dict):
+            cache = {}
+        cache[name] = {"timestamp": time.time(),
+                       "timeout": timeout,
+                       "res": ret_val}
+        ttl = timeout
+        if failures:
+            cache[name]["failures"] = failures
+            # Kept past the backoff, so failures in a row add up.
+            ttl = self.error_backoff
+        self._log(u"Saving cache: {0}{1}".format(name, str(
+            repr(cache[name]["res"]))[0:50]), 1)
+        # Kept on the server for the stale window too.
+        return storageservercodec.encodeValue(cache), ttl + self.stale
+
+    def _cacheKey(self, funct, args, kwargs, ttl=None, version=None):
+        # The name and timeout of a cacheFunction result.
+        timeout = self.timeout if ttl is None else float(ttl)
+        name = self._generateKey(funct, *args, **kwargs)
+        if version is not None:
+            name = u"{0}{1}|".format(name, version)
+        return name, timeout
+
+    def _cacheLookup(self, name, res):
+        # The cache stored for name, the failures in a row it records, the
+        # result found in it or _MISSING, and whether the result is stale.
+        cache = self._evaluate(res) if res else {}
+        failures = 0
+        if name in cache:
+            failures = cache[name].get("failures", 0)
+
+        ret_val = self._getStale(name, cache)
+        if ret_val is not _MISSING:
+            return cache, failures, ret_val, True
+        return cache, failures, self._getCache(name, cache), False
+
+    def _cacheReturn(self, ret_val):
+        if ret_val:
+            self._log(u"Returning result: {0}".format(str(len(ret_val))))
+            self._log(ret_val, 4)
+            return ret_val
+        self._log(u"Returning []. Got result: {0}".format(repr(ret_val)))
+        return []
 
 
 # EXTERNAL FUNCTIONS #
-    soccon = False
     table = False
+    # Values this process read or wrote are kept in _memory for up to ten
+    # seconds, never past their expiry. Changes other processes make in
+    # that time aren't seen, turn it off where that matters.
+    memory_cache = None
+    _posix_sockets = None
+    _address = None
+    _local = None
+
+    def cacheFunction(self, funct=False, *args, **kwargs):
+        return self._cacheCall(funct, args, kwargs)
+
+    def cached(self, ttl=None, version=None):
+        # Decorator, like cacheFunction for ttl seconds. A new version leaves
+        # the old results behind, wrapper.warm(calls) fills the cache.
+        def decorator(funct):
+            @functools.wraps(funct)
+            def wrapper(*args, **kwargs):
+                return self._cacheCall(funct, args, kwargs, ttl, version)
+
+            def warm(calls, workers=2):
+                return self.warm(wrapper, calls, workers)
+
+            wrapper.warm = warm
+            return wrapper
+        return decorator
+
+    def warm(self, funct, calls, workers=2):
+        # Run funct, cached() or for cacheFunction, for every argument tuple in
+        # calls on at most workers background threads, each call once Kodi
+        # has been idle for warm_idle seconds. Returns len(calls).
+        if getattr(funct, "warm", None) is None:
+            funct = functools.partial(self.cacheFunction, funct)
+
+        pool = _RefreshPool(workers)
+        for index, args in enumerate(calls):
+            if not isinstance(args, (list, tuple)):
+                args = (args, )
+            pool.submit(index, self._warm, funct, args)
+        return len(calls)
+
+    def _warm(self, funct, args):
+        while not self._aborting():
+            if self._kodiIdle():
+                funct(*args)
+                return
+            time.sleep(1)
+
+    def _kodiIdle(self):
+        return self.xbmc.getGlobalIdleTime() >= self.warm_idle
 
-    def cacheFunction(self, funct=False, *args):
+    def _cacheCall(self, funct, args, kwargs, ttl=None, version=None):
         self._log(u"function : {0} - table_name: {1}".format(repr(funct),
                                                              repr(self.table)))
         if funct and self.table:
-            name = self._generateKey(funct, *args)
-            cache = self.get("cache{0}".format(name))
+            name, timeout = self._cacheKey(funct, args, kwargs, ttl, version)
+            cache, failures, ret_val, stale = self._cacheLookup(
+                name, self.get("cache{0}".format(name)))
+            if stale:
+                _refresher.submit((self.table, name), self._refresh, funct,
+                                  name, args, kwargs, timeout)
 
-            if cache.strip() == "":
-                cache = {}
-            else:
-                cache = self._evaluate(cache)
+            if ret_val is _MISSING and self.flight_timeout:
+                ret_val = self._awaitFlight(name)
 
-            ret_val = self._getCache(name, cache)
-
-            if not ret_val:
+            if ret_val is _MISSING:
                 self._log(
                     u"Running: {0}".format(text(name)))
-                ret_val = funct(*args)
-                self._setCache(cache, name, ret_val)
+                try:
+                    ret_val = funct(*args, **kwargs)
+                except Exception:
+                    if not (self.negative_errors and self._setCache(
+                            cache, name, [], timeout, failures + 1)):
+                        self._endFlight(name)
+                    raise
+                except:
+                    self._endFlight(name)
+                    raise
+                if not self._setCache(cache, name, ret_val, timeout):
+                    self._endFlight(name)
 
-            if ret_val:
-                self._log(u"Returning result: {0}".format(str(len(ret_val))))
-                self._log(ret_val, 4)
-                return ret_val
-            else:
-                self._log(
-                    u"Returning []. Got result: {0}".format(repr(ret_val)))
-                return []
+            return self._cacheReturn(ret_val)
 
         self._log(u"Error")
         return []
 
     def cacheDelete(self, name):
         self._log(name, 1)
-        if self._connect() and self.table:
-            temp = repr({"action": "del", "table": self.table,
-                         "name": "cache{0}".format(name)})
-            self._send(self.soccon, temp)
-            res = self._recv(self.soccon)
+        if self.table:
+            res = self._request({"action": "del", "table": self.table,
+                                 "name": "cache{0}".format(name)})
+            _memory.invalidate(self.table)
             self._log(u"GOT {0}".format(repr(res)), 3)
 
     def cacheClean(self, empty=False):
+        # Remove this table's expired cacheFunction entries now, or all.
         self._log(u"")
         if self.table:
-            cache = self.get("cache{0}".format(self.table))
-
-            try:
-                cache = self._evaluate(cache)
-            except:
-                self._log(
-                    u"Couldn't evaluate message : {0}".format(repr(cache)))
-
-            self._log(u"Cache : {0}".format(repr(cache)), 5)
-            if cache:
-                new_cache = {}
-                for item in cache:
-                    if (cache[item]["timestamp"] > time.time() - (
-                            3600)) and not empty:
-                        new_cache[item] = cache[item]
-                    else:
-                        self._log(u"Deleting: {0}".format(
-                            item.decode('utf8', 'ignore')))
-
-                self.set("cache", repr(new_cache))
+            res = self._request({"action": "clean", "table": self.table,
+                                 "empty": empty})
+            _memory.invalidate(self.table)
+            if res is not None:
+                self._log(u"Removed {0}".format(res), 1)
                 return True
 
         return False
 
-    def lock(self, name):
+    def stats(self):
+        # Counters kept by the server since it started.
+        res = self._request({"action": "stats"})
+        if isinstance(res, dict):
+            return res
+        return {}
+
+    def lock(self, name, timeout=0, lease=None):
+        # Take the lock name for this process, waiting up to timeout seconds.
+        # It is released after lease seconds even without unlock.
         self._log(name, 1)
         self._log(self.table, 1)
 
-        if self._connect() and self.table:
-            data = repr({"action": "lock", "table": self.table, "name": name})
-            self._send(self.soccon, data)
-            res = self._recv(self.soccon)
-            if res:
-                res = self._evaluate(res)
-
-                if res == "true":
-                    self._log(u"Done : {0}".format(res.strip()), 1)
-                    return True
+        if self.table:
+            res = self._request(self._lockRequest(name, timeout, lease),
+                                timeout)
+            if res == "true":
+                self._log(u"Done : {0}".format(res), 1)
+                return True
 
         self._log(u"Failed", 1)
         return False
 
     def unlock(self, name):
+        # Release a lock taken by this process.
         self._log(name, 1)
 
-        if self._connect() and self.table:
-            data = repr(
-                {"action": "unlock", "table": self.table, "name": name})
-            self._send(self.soccon, data)
-            res = self._recv(self.soccon)
-            if res:
-                res = self._evaluate(res)
-
-                if res == "true":
-                    self._log(u"Done: {0}".format(res.strip()), 1)
-                    return True
+        if self.table:
+            res = self._request(self._unlockRequest(name))
+            if res == "true":
+                self._log(u"Done: {0}".format(res), 1)
+                return True
 
         self._log(u"Failed", 1)
         return False
 
+    def _lockRequest(self, name, timeout=0, lease=None):
+        return {"action": "lock", "table": self.table, "name": name,
+                "owner": _lockOwner(), "lease": lease, "timeout": timeout}
+
+    def _unlockRequest(self, name):
+        return {"action": "unlock", "table": self.table, "name": name,
+                "owner": _lockOwner()}
+
     def _connect(self):
         self._log("", 3)
         self._sock_init()
 
         if self._usePosixSockets():
-            self.soccon = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            soccon = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         else:
-            self.soccon = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            soccon = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            soccon.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        connected = False
         try:
-            self.soccon.connect(self.socket)
-            connected = True
+            soccon.settimeout(self.network_timeout)
+            soccon.connect(self.socket)
+            return soccon
         except socket.error as e:
             if e.errno in [111]:
                 self._log(u"StorageServer isn't running")
@@ -751,71 +2730,295 @@ class StorageServer():
                 self._log(u"Exception: {0}".format(repr(e)))
                 self._log(u"Exception: {0}".format(repr(self.socket)))
 
-        return connected
+        soccon.close()
+        return None
+
+    def _request(self, data, wait=0):
+        # The server's answer or None. A server in this process gets the
+        # request directly. wait is extra seconds the server may take.
+        if self.namespace_name is not None:
+            data = dict(data, namespace=self.namespace_name)
+        local = StorageServer._local
+        if local is not None and self.local_dispatch:
+            return local.request(data, self.network_timeout + float(wait))
+
+        res = self._socketRequest(data, wait)
+        return self._evaluate(res) if res else None
+
+    def _socketRequest(self, data, wait=0):
+        # The raw answer over a pooled connection, or "". A dead pooled
+        # connection is replaced by a fresh one once.
+        data = storageservercodec.encode(data)
+        for attempt in range(2):
+            soccon = _pool.acquire()
+            fresh = soccon is None
+            if fresh:
+                soccon = self._connect()
+                if not soccon:
+                    return ""
+
+            if wait:
+                soccon.settimeout(self.network_timeout + float(wait))
+            if self._send(soccon, data):
+                res = self._recv(soccon)
+                if res:
+                    if wait:
+                        soccon.settimeout(self.network_timeout)
+                    _pool.release(soccon)
+                    return res
 
-    def setMulti(self, name, data):
+            soccon.close()
+            if fresh:
+                break
+            self._log(u"Pooled connection died, reconnecting", 2)
+
+        return ""
+
+    def setMulti(self, name, data, ttl=None):
         self._log(name, 1)
-        if self._connect() and self.table:
-            temp = repr(
-                {"action": "set_multi", "table": self.table, "name": name,
-                 "data": data})
-            res = self._send(self.soccon, temp)
+        if self.table:
+            res = self._request(self._setMultiRequest(name, data, ttl))
             self._log(u"GOT {0}".format(repr(res)), 3)
+            if res is not None:
+                for key in data:
+                    self._remember(u"{0}{1}".format(name, key), data[key], ttl)
 
     def getMulti(self, name, items):
         self._log(name, 1)
-        if self._connect() and self.table:
-            self._send(self.soccon, repr(
+        if self.table:
+            res = self._request(
                 {"action": "get_multi", "table": self.table, "name": name,
-                 "items": items}))
-            self._log(u"Receive", 3)
-            res = self._recv(self.soccon)
+                 "items": items})
+            return self._multiResult(res)
 
-            self._log(u"res : {0}".format(str(len(res))), 3)
-            if res:
-                res = self._evaluate(res)
+        return ""
 
-                if res == " ":  # We return " " as nothing.
-                    return ""
-                else:
-                    return res
+    def getMultiMap(self, name, items):
+        # Like getMulti, as a dict holding only the items found.
+        self._log(name, 1)
+        if self.table:
+            res = self._request(
+                {"action": "get_map", "table": self.table, "name": name,
+                 "items": items})
+            return self._mapResult(items, res)
 
-        return ""
+        return {}
+
+    def pipeline(self):
+        # Operations sent in one round trip, see Pipeline.
+        return Pipeline(self)
+
+    def snapshot(self, name=None, enabled=True):
+        # Publish this table, or only name, in the snapshot file that get()
+        # reads without asking the server.
+        self._log(name, 1)
+        if self.table:
+            res = self._request(
+                {"action": "snapshot", "table": self.table, "name": name,
+                 "enabled": enabled})
+            return res == "true"
+        return False
+
+    def getStream(self, name, chunk_size=65536):
+        # A file-like reader of the bytes stored under name.
+        return StreamReader(self, name, chunk_size)
+
+    def setStream(self, name, size, ttl=None, chunk_size=65536):
+        # A file-like writer storing the size bytes written to it under name.
+        return StreamWriter(self, name, size, ttl, chunk_size)
+
+    def namespace(self, name):
+        # A StorageServer for the entries of namespace name in this table,
+        # which invalidate() drops all at once.
+        namespaced = copy.copy(self)
+        namespaced.namespace_name = u"{0}".format(name)
+        return namespaced
+
+    def invalidate(self, eager=False):
+        # Drop every entry of this namespace, at the same cost however many.
+        # Other processes' memory caches may keep them for a few seconds.
+        self._log(self.namespace_name, 1)
+        if self.table and self.namespace_name is not None:
+            res = self._request({"action": "invalidate", "table": self.table,
+                                 "eager": eager})
+            _memory.invalidate(self.table)
+            return res == "true"
+        return False
+
+    def deletePrefix(self, prefix):
+        # Delete the names starting with prefix, found with the index.
+        self._log(prefix, 1)
+        if self.table:
+            res = self._request({"action": "del_prefix", "table": self.table,
+                                 "name": prefix})
+            _memory.invalidate(self.table)
+            return res == "true"
+        return False
 
     def delete(self, name):
         self._log(name, 1)
-        if self._connect() and self.table:
-            temp = repr({"action": "del", "table": self.table, "name": name})
-            self._send(self.soccon, temp)
-            res = self._recv(self.soccon)
+        if self.table:
+            res = self._request(
+                {"action": "del", "table": self.table, "name": name})
+            # The server matches name with LIKE, so forget the whole table.
+            _memory.invalidate(self.table)
             self._log(u"GOT {0}".format(repr(res)), 3)
 
-    def set(self, name, data):
+    def set(self, name, data, ttl=None):
+        # With a ttl in seconds the entry is missing once it expires.
         self._log(name, 1)
-        if self._connect() and self.table:
-            temp = repr({"action": "set", "table": self.table, "name": name,
-                         "data": data})
-            res = self._send(self.soccon, temp)
+        if self.table:
+            res = self._request(self._setRequest(name, data, ttl))
             self._log(u"GOT {0}".format(repr(res)), 3)
+            if res is not None:
+                self._remember(name, data, ttl)
 
     def get(self, name):
         self._log(name, 1)
-        if self._connect() and self.table:
-            self._send(self.soccon, repr(
-                {"action": "get", "table": self.table, "name": name}))
-            self._log(u"Receive", 3)
-            res = self._recv(self.soccon)
+        if self.table:
+            res = self._memoryGet(name)
+            if res is not None:
+                return res
 
-            self._log(u"res : {0}".format(str(len(res))), 3)
-            if res:
-                res = self._evaluate(res)
-                return res.strip()  # We return " " as nothing. Strip it out.
+            res = self._snapshotGet(name)
+            if res is None:
+                res = self._request(self._getRequest(name))
+            return self._gotValue(name, res)
 
         return ""
 
+    def _deflate(self, data):
+        # Compressed here, the server stores and returns it as it is.
+        if (self.compression and isinstance(data, (bytes, text)) and
+                len(data) >= self.compression_threshold):
+            return storageservercodec.compress(data, self.compression,
+                                               self.compression_level)
+        return data
+
+    def _inflate(self, data):
+        if storageservercodec.compressed(data):
+            return storageservercodec.decompress(data)
+        return data
+
+    # The requests and answers of the calls above, shared with
+    # AsyncStorageServer and Pipeline, which only send them differently.
+
+    def _getRequest(self, name):
+        # Answered with the value and the seconds it has left, which bound
+        # how long the memory cache keeps it.
+        return {"action": "get", "table": self.table, "name": name,
+                "remaining": True}
+
+    def _setRequest(self, name, data, ttl=None):
+        return {"action": "set", "table": self.table, "name": name,
+                "data": self._deflate(data), "ttl": ttl, "quota": self.quota}
+
+    def _setMultiRequest(self, name, data, ttl=None):
+        return {"action": "set_multi", "table": self.table, "name": name,
+                "data": dict((key, self._deflate(data[key]))
+                             for key in data),
+                "ttl": ttl, "quota": self.quota}
+
+    def _memoryGet(self, name):
+        if self.memory_cache:
+            res = _memory.get(self._memoryKey(name))
+            if res is not None:
+                self._log(u"memory hit", 3)
+                return res
+        return None
+
+    def _snapshotGet(self, name):
+        # The snapshot holds names resolved by the server.
+        if self.snapshot_reads and self.namespace_name is None:
+            res = _snapshot.get(self._snapshotPath(), self.table, name)
+            if res is not None:
+                self._log(u"snapshot hit", 3)
+                return res
+        return None
+
+    def _gotValue(self, name, res):
+        # What get returns for the answer res, the stored value, remembered
+        # in memory no longer than it has left.
+        ttl = None
+        if isinstance(res, list):
+            res, ttl = res
+        if not res:
+            return ""
+        self._log(u"res : {0}".format(str(len(res))), 3)
+        res = self._value(res)
+        if res and self.memory_cache and (ttl is None or ttl > 0):
+            _memory.set(self._memoryKey(name), res, ttl)
+        return res
+
+    def _value(self, res):
+        res = self._inflate(res)
+        if not isinstance(res, bytes):  # Binary encoded value.
+            res = res.strip()  # We return " " as nothing.
+        return res
+
+    def _multiResult(self, res):
+        if not res or res == " ":  # We return " " as nothing.
+            return ""
+        self._log(u"res : {0}".format(str(len(res))), 3)
+        return [self._inflate(value) for value in res]
+
+    def _mapResult(self, items, res):
+        if not isinstance(res, dict):
+            return {}
+        return dict((item, self._inflate(res[u"{0}".format(item)]))
+                    for item in items if u"{0}".format(item) in res)
+
+    def _remember(self, name, data, ttl):
+        if not self.memory_cache:
+            return
+        if not isinstance(data, bytes):
+            try:
+                data = data.strip()
+            except AttributeError:
+                return
+        if data:
+            _memory.set(self._memoryKey(name), data, ttl)
+        else:
+            _memory.discard(self._memoryKey(name))
+
+    def _memoryKey(self, name):
+        if self.namespace_name is None:
+            return (self.table, name)
+        return (self.table, name, self.namespace_name)
+
     def setCacheTimeout(self, timeout):
         self.timeout = float(timeout) * 3600
 
+    def setStaleTimeout(self, timeout):
+        # For timeout hours after a cacheFunction result expires it is
+        # returned while a background thread refreshes it.
+        self.stale = float(timeout) * 3600
+
+    def setNegativeTimeout(self, timeout, errors=False):
+        # Keep empty cacheFunction results for timeout seconds. With
+        # errors a call that raises is backed off, doubling up to
+        # error_backoff.
+        self.negative_timeout = float(timeout)
+        self.negative_errors = errors
+
+    def setCompression(self, method, level=6, threshold=16):
+        # Compress values of threshold KB and up with method, "zlib" or
+        # "lzma" (None for off). Older clients can't read them.
+        if method not in storageservercodec.COMPRESSORS:
+            method = None
+        self.compression = method
+        self.compression_level = int(level)
+        self.compression_threshold = int(float(threshold) * 1024)
+
+    def setFlightTimeout(self, timeout):
+        # Seconds to wait for another client computing the same value.
+        self.flight_timeout = timeout
+
+    def setQuota(self, megabytes):
+        # Limit this table's size, evicting least recently used entries. None
+        # or 0 leaves only the global limit.
+        self.quota = megabytes
+
     def _log(self, description, level=0):
         if self.dbg and self.dbglevel > level:
             self.xbmc.log(u"[{0}] {1} : {2}".format(self.plugin, repr(
@@ -823,6 +3026,212 @@ class StorageServer():
                           self.xbmc.LOGNOTICE)
 
 
+# Queued operations, sent as one batch that the server runs in a single
+# transaction. results has one result per operation, None for writes
+# and failures.
+class Pipeline(object):
+    def __init__(self, storage):
+        self.storage = storage
+        self.operations = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+    def _queue(self, action, name, table=None, **data):
+        data.update({"action": action, "name": name,
+                     "table": _tableName(table) if table
+                     else self.storage.table})
+        if self.storage.namespace_name is not None:
+            data["namespace"] = self.storage.namespace_name
+        self.operations.append(data)
+        return self
+
+    def get(self, name, table=None):
+        return self._queue("get", name, table)
+
+    def getMulti(self, name, items, table=None):
+        return self._queue("get_multi", name, table, items=items)
+
+    def getMultiMap(self, name, items, table=None):
+        return self._queue("get_map", name, table, items=items)
+
+    def set(self, name, data, ttl=None, table=None):
+        return self._queue("set", name, table,
+                           data=self.storage._deflate(data), ttl=ttl,
+                           quota=None if table else self.storage.quota)
+
+    def setMulti(self, name, data, ttl=None, table=None):
+        return self._queue("set_multi", name, table,
+                           data=dict((key, self.storage._deflate(data[key]))
+                                     for key in data), ttl=ttl,
+                           quota=None if table else self.storage.quota)
+
+    def delete(self, name, table=None):
+        return self._queue("del", name, table)
+
+    def lock(self, name, lease=None, table=None):
+        return self._queue("lock", name, table, owner=_lockOwner(),
+                           lease=lease)
+
+    def unlock(self, name, table=None):
+        return self._queue("unlock", name, table, owner=_lockOwner())
+
+    def execute(self):
+        operations, self.operations = self.operations, []
+        self.results = [None] * len(operations)
+        if not operations:
+            return self.results
+
+        res = self.storage._request({"action": "batch",
+                                     "operations": operations})
+        if not isinstance(res, list):
+            return self.results
+
+        for index, (operation, result) in enumerate(zip(operations, res)):
+            self.results[index] = self._result(operation, result)
+        return self.results
+
+    def _result(self, operation, result):
+        action = operation["action"]
+        table = operation["table"]
+        if action in ("del", "set", "set_multi"):
+            # Keep this process' memory cache coherent with the batch.
+            _memory.invalidate(table)
+        if result is None:
+            return None
+        if action == "get":
+            return self.storage._value(result)
+        if action == "get_map":
+            return self.storage._mapResult(operation["items"], result)
+        if action in ("lock", "unlock"):
+            return result == "true"
+        if action == "get_multi":
+            return self.storage._multiResult(result)
+        return None
+
+
+# Reads a stored value chunk_size bytes per request. Text reads as
+# UTF-8, a missing value as b"".
+class StreamReader(object):
+    def __init__(self, storage, name, chunk_size=65536):
+        self.storage = storage
+        self.name = name
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.buffer = b""
+        self.done = not storage.table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __iter__(self):
+        if self.buffer:
+            chunk, self.buffer = self.buffer, b""
+            yield chunk
+        while not self.done:
+            chunk = self._fetch()
+            if chunk:
+                yield chunk
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        have = len(self.buffer)
+        while (size < 0 or have < size) and not self.done:
+            chunk = self._fetch()
+            parts.append(chunk)
+            have += len(chunk)
+
+        data = b"".join(parts)
+        if size < 0:
+            self.buffer = b""
+        else:
+            data, self.buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        self.done = True
+        self.buffer = b""
+
+    def _fetch(self):
+        chunk = self.storage._request(
+            {"action": "read_stream", "table": self.storage.table,
+             "name": self.name, "offset": self.offset,
+             "size": self.chunk_size})
+        if isinstance(chunk, text):
+            # Python 2's json reads bytes that are valid UTF-8 as text.
+            chunk = chunk.encode('utf-8')
+        elif not isinstance(chunk, bytes):
+            chunk = b""
+        self.offset += len(chunk)
+        if len(chunk) < self.chunk_size:
+            self.done = True
+        return chunk
+
+
+# Stores exactly size bytes written to it under name, chunk_size bytes
+# per request. close() returns whether all of it was stored, the value
+# under name only changes when it was.
+class StreamWriter(object):
+    def __init__(self, storage, name, size, ttl=None, chunk_size=65536):
+        self.storage = storage
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.buffer = bytearray()
+        self.failed = not storage.table
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write(self, data):
+        if isinstance(data, text):
+            data = data.encode('utf-8')
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._send(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.buffer or self.offset < self.size or not self.offset:
+                self._send(bytes(self.buffer), True)
+            self.buffer = bytearray()
+            _memory.discard(self.storage._memoryKey(self.name))
+        return not self.failed and self.offset == self.size
+
+    def _send(self, chunk, final=False):
+        if self.failed:
+            return
+        res = self.storage._request(
+            {"action": "write_stream", "table": self.storage.table,
+             "name": self.name, "data": chunk, "offset": self.offset,
+             "size": self.size, "ttl": self.ttl, "final": final,
+             "quota": self.storage.quota})
+        if res != "true":
+            self.storage._log(u"Failed at {0}".format(self.offset))
+            self.failed = True
+        self.offset += len(chunk)
+
+
 # Check if this module should be run in instance mode or not.
 __workersByName = {}
 
@@ -0,0 +1,272 @@
+'''
+     StorageServer value codecs.
+
+     Every encoded value starts with a one byte tag naming the codec that
+     wrote it, so readers never have to guess. Values without a known tag
+     were written by older versions with repr() and are read back with
+     ast.literal_eval, which only accepts literals and never runs code.
+
+     msgpack is used when it is installed, otherwise the built-in binary
+     codec, or JSON on Python 2. JSON carries bytes as {"__bytes__":
+     base64}, the binary codec appends them as they are. None of them keep
+     tuples, and JSON and the binary codec turn dictionary keys into
+     strings, so values holding those are written with the repr codec, as
+     are values a codec can't represent at all.
+
+     Large values can be compressed: compress() returns a header, the tag
+     of the compressor and the compressed encoded value, as bytes so the
+     server stores it as a BLOB without looking inside.
+'''
+import ast
+import base64
+import json
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _jsonDefault(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return {"__bytes__": base64.b64encode(bytes(obj)).decode('ascii')}
+    raise TypeError(repr(obj))
+
+
+def _jsonBytes(obj):
+    if len(obj) == 1 and "__bytes__" in obj:
+        return base64.b64decode(obj["__bytes__"])
+    return obj
+
+
+class JSONCodec(object):
+    tag = b"j"
+    binary = False
+    exact = False
+    text_keys = True
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":"),
+                          default=_jsonDefault).encode('utf-8')
+
+    def loads(self, data):
+        # The object hook costs, only pay for it when there are bytes.
+        if b'{"__bytes__":' in data:
+            return json.loads(data.decode('utf-8'), object_hook=_jsonBytes)
+        return json.loads(data.decode('utf-8'))
+
+
+_SIZE = struct.Struct("!I")
+
+
+class BinaryCodec(object):
+    # Built in, for when msgpack isn't installed: the size of the JSON of
+    # the value, that JSON, then each bytes object in it with its size. The
+    # JSON holds {"__bytes__": index} in place of the bytes.
+    tag = b"b"
+    binary = True
+    exact = False
+    text_keys = True
+
+    def dumps(self, obj):
+        parts = []
+
+        def default(obj):
+            if isinstance(obj, (bytes, bytearray)):
+                parts.append(bytes(obj))
+                return {"__bytes__": len(parts) - 1}
+            raise TypeError(repr(obj))
+
+        data = json.dumps(obj, separators=(",", ":"),
+                          default=default).encode('utf-8')
+        out = [_SIZE.pack(len(data)), data]
+        for part in parts:
+            out.append(_SIZE.pack(len(part)))
+            out.append(part)
+        return b"".join(out)
+
+    def loads(self, data):
+        end = _SIZE.size + _SIZE.unpack_from(data, 0)[0]
+        document = data[_SIZE.size:end].decode('utf-8')
+        if end == len(data):
+            return json.loads(document)
+
+        parts = []
+        while end < len(data):
+            size = _SIZE.unpack_from(data, end)[0]
+            end += _SIZE.size
+            parts.append(data[end:end + size])
+            end += size
+
+        def hook(obj):
+            if len(obj) == 1 and "__bytes__" in obj:
+                return parts[obj["__bytes__"]]
+            return obj
+
+        return json.loads(document, object_hook=hook)
+
+
+class MsgpackCodec(object):
+    tag = b"m"
+    binary = True
+    exact = False
+    text_keys = False
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except TypeError:  # msgpack < 1.0
+            return msgpack.unpackb(data, raw=False)
+
+
+class ReprCodec(object):
+    tag = b"r"
+    binary = False
+    exact = True
+    text_keys = False
+
+    def dumps(self, obj):
+        return repr(obj).encode('utf-8')
+
+    def loads(self, data):
+        return ast.literal_eval(data.decode('utf-8'))
+
+
+CODECS = {}
+
+
+def registerCodec(codec):
+    CODECS[codec.tag] = codec
+    return codec
+
+
+registerCodec(JSONCodec())
+registerCodec(ReprCodec())
+registerCodec(BinaryCodec())
+if msgpack:
+    DEFAULT_CODEC = registerCodec(MsgpackCodec())
+elif bytes is str:
+    # Python 2 stores str as text, so values stay text there.
+    DEFAULT_CODEC = CODECS[JSONCodec.tag]
+else:
+    DEFAULT_CODEC = CODECS[BinaryCodec.tag]
+
+
+_TEXT = (type(u""), str)
+
+
+def lossless(obj, text_keys=False):
+    # Whether obj has no tuples, and with text_keys only text dictionary
+    # keys, so that every codec gives it back as it was.
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            for key in obj:
+                if isinstance(key, tuple) or (
+                        text_keys and not isinstance(key, _TEXT)):
+                    return False
+            stack.extend(obj.values())
+        elif isinstance(obj, list):
+            stack.extend(obj)
+        elif isinstance(obj, tuple):
+            return False
+    return True
+
+
+def encode(obj, codec=None):
+    codec = codec or DEFAULT_CODEC
+    if not codec.exact and not lossless(obj, codec.text_keys):
+        codec = CODECS[ReprCodec.tag]
+    try:
+        return codec.tag + codec.dumps(obj)
+    except (TypeError, ValueError, OverflowError):
+        codec = CODECS[ReprCodec.tag]
+        return codec.tag + codec.dumps(obj)
+
+
+def encodeValue(obj, codec=None):
+    # Like encode, but text for codecs that produce text, so the value can
+    # be stored in a text column and sent in any envelope.
+    data = encode(obj, codec)
+    if CODECS[data[:1]].binary:
+        return data
+    return data.decode('utf-8')
+
+
+class ZlibCompressor(object):
+    tag = b"z"
+
+    def compress(self, data, level):
+        return zlib.compress(data, level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LZMACompressor(object):
+    tag = b"x"
+
+    def compress(self, data, level):
+        return lzma.compress(data, preset=level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+COMPRESSED = b"\x00SC"
+COMPRESSORS = {"zlib": ZlibCompressor()}
+if lzma:
+    COMPRESSORS["lzma"] = LZMACompressor()
+_DECOMPRESSORS = dict((compressor.tag, compressor)
+                      for compressor in COMPRESSORS.values())
+
+
+def compress(obj, method="zlib", level=6, codec=None):
+    # obj compressed with the named compressor, or obj itself when that
+    # doesn't make it smaller.
+    compressor = COMPRESSORS[method]
+    data = encode(obj, codec)
+    packed = COMPRESSED + compressor.tag + compressor.compress(data, level)
+    if len(packed) >= len(data):
+        return obj
+    return packed
+
+
+def compressed(data):
+    return isinstance(data, bytes) and data.startswith(COMPRESSED)
+
+
+def decompress(data):
+    compressor = _DECOMPRESSORS[data[len(COMPRESSED):len(COMPRESSED) + 1]]
+    return decode(compressor.decompress(data[len(COMPRESSED) + 1:]))
+
+
+def _bytes(data):
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, bytearray):
+        return bytes(data)
+    return data.encode('utf-8')
+
+
+def codecOf(data):
+    return CODECS.get(_bytes(data)[:1])
+
+
+def decode(data):
+    data = _bytes(data)
+    codec = CODECS.get(data[:1])
+    if codec:
+        return codec.loads(data[1:])
+    return ast.literal_eval(data.decode('utf-8').strip())
@@ -2,29 +2,104 @@
      StorageServer override.
      Version: 1.0
 '''
+import io
 
 
 class StorageServer:
     def __init__(self, table, timeout=24):
         return None
 
-    def cacheFunction(self, funct=False, *args):
-        return funct(*args)
+    def cacheFunction(self, funct=False, *args, **kwargs):
+        return funct(*args, **kwargs)
 
-    def set(self, name, data):
+    def cached(self, ttl=None, version=None):
+        def decorator(funct):
+            funct.warm = lambda calls, workers=2: len(calls)
+            return funct
+        return decorator
+
+    def warm(self, funct, calls, workers=2):
+        return len(calls)
+
+    def set(self, name, data, ttl=None):
         return ""
 
     def get(self, name):
         return ""
 
-    def setMulti(self, name, data):
+    def setMulti(self, name, data, ttl=None):
         return ""
 
     def getMulti(self, name, items):
         return ""
 
-    def lock(self, name):
+    def getMultiMap(self, name, items):
+        return {}
+
+    def snapshot(self, name=None, enabled=True):
+        return False
+
+    def getStream(self, name, chunk_size=65536):
+        return io.BytesIO()
+
+    def setStream(self, name, size, ttl=None, chunk_size=65536):
+        return io.BytesIO()
+
+    def pipeline(self):
+        return Pipeline()
+
+    def namespace(self, name):
+        return self
+
+    def invalidate(self, eager=False):
+        return False
+
+    def deletePrefix(self, prefix):
+        return False
+
+    def lock(self, name, timeout=0, lease=None):
         return False
 
     def unlock(self, name):
         return False
+
+    def setStaleTimeout(self, timeout):
+        return None
+
+    def setNegativeTimeout(self, timeout, errors=False):
+        return None
+
+    def setCompression(self, method, level=6, threshold=16):
+        return None
+
+    def setFlightTimeout(self, timeout):
+        return None
+
+    def setQuota(self, megabytes):
+        return None
+
+
+class Pipeline:
+    def __init__(self):
+        self.operations = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+    def _queue(self, *args, **kwargs):
+        self.operations.append(None)
+        return self
+
+    get = getMulti = getMultiMap = set = setMulti = _queue
+    delete = lock = unlock = _queue
+
+    def execute(self):
+        self.results = [None] * len(self.operations)
+        self.operations = []
+        return self.results